@@ -1,40 +1,89 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import psycopg2
+import csv
+import hashlib
+import os
+import shutil
+import tempfile
+from functools import partial
+import time
 from io import BytesIO
 from datetime import datetime
+import xlsxwriter
+
+from distribucion_pipeline import (
+    CLAVE_RESUMEN, TABLA_RESULTADOS, MaestrosCompartidos, PoolCompartido, TablaParquet, agregados_validacion,
+    combinar_agregados, escribir_parte, escribir_resultados_postgres, excepciones_de, iterar_partes, nombres_de_hojas,
+    normalizar_tareo, procesar_delta, procesar_distribucion, procesar_fuera_de_memoria, procesar_por_shards,
+    resumen_validacion, sumar_horas_validacion, validar_distribucion
+)
 
 st.set_page_config(page_title="Distribución de horas según porcentajes Packing-Maquila (ZUPRA)", layout="wide")
 
 
 # ---------------- Conexión a PostgreSQL ----------------
-def get_postgres_data():
-    """Conecta a Postgres usando st.secrets y devuelve DataFrame.
-    Ajusta según tu entorno si no usas st.secrets.
+def get_postgres_connection():
+    """Abre una conexión a Postgres usando st.secrets.
+    `port` y `sslmode` son opcionales en secrets (por defecto 5432 y "require"),
+    p. ej. sslmode "disable" para un Postgres local.
     """
-    conn = psycopg2.connect(
+    return psycopg2.connect(
         host=st.secrets["postgres"]["host"],
+        port=st.secrets["postgres"].get("port", 5432),
         dbname=st.secrets["postgres"]["dbname"],
         user=st.secrets["postgres"]["user"],
         password=st.secrets["postgres"]["password"],
-        sslmode="require"
+        sslmode=st.secrets["postgres"].get("sslmode", "require")
     )
-    query = """
-    SELECT *
-    FROM raw.pe_ccoz_distribuciongth;
-    """
-    df = pd.read_sql(query, conn)
-    conn.close()
-    return df
 
-# ---------------- Helpers ----------------
 
-def safe_str(x):
-    if pd.isna(x):
-        return ""
-    return str(x).strip()
+# Tipos explícitos para las columnas que usa la distribución; el resto se lee como texto
+# (sin inferencia: un código "0012" no se convierte en 12)
+DTYPES_POSTGRES = {"area": "string", "packing": "float64", "servicio_maquila": "float64"}
+COLUMNAS_FECHA_POSTGRES = ["fecha"]
+
+
+def get_postgres_data():
+    """Conecta a Postgres usando st.secrets y devuelve (DataFrame, estadísticas).
+    La tabla se transfiere con COPY ... TO STDOUT (CSV) y se arma en columnas con
+    tipos explícitos, en vez de construir el DataFrame fila a fila con pd.read_sql.
+    Ajusta según tu entorno si no usas st.secrets.
+    """
+    conn = get_postgres_connection()
+    query = "SELECT * FROM raw.pe_ccoz_distribuciongth"
+    buffer = BytesIO()
+    inicio = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", buffer)
+    finally:
+        conn.close()
+    segundos_fetch = time.perf_counter() - inicio
+    bytes_transferidos = buffer.tell()
+    # Los nombres de columna salen del encabezado del CSV, sin otra consulta
+    buffer.seek(0)
+    columnas = next(csv.reader([buffer.readline().decode("utf-8")]), [])
+    buffer.seek(0)
+
+    df = pd.read_csv(
+        buffer,
+        dtype={c: DTYPES_POSTGRES.get(c, "string") for c in columnas if c not in COLUMNAS_FECHA_POSTGRES},
+        parse_dates=[c for c in COLUMNAS_FECHA_POSTGRES if c in columnas],
+        date_format="ISO8601",
+    )
+    stats = {
+        "filas": len(df),
+        "bytes": bytes_transferidos,
+        "segundos_fetch": segundos_fetch,
+        "segundos_total": time.perf_counter() - inicio,
+    }
+    return df, stats
+
 
+# ---------------- Helpers ----------------
 
 def ensure_date(x):
     try:
@@ -43,26 +92,428 @@ def ensure_date(x):
         return None
 
 
+@st.cache_resource
+def get_maestros():
+    """Maestros DNI / LABORES compartidos por todas las sesiones del servidor."""
+    return MaestrosCompartidos()
+
+
+@st.cache_resource
+def get_pool_compartido():
+    """Único pool de procesos del servidor para el modo paralelo por shards."""
+    return PoolCompartido()
+
+
+def nuevo_directorio_trabajo():
+    """Directorio temporal de la sesión para el modo de memoria acotada (se reemplaza en cada corrida)."""
+    previo = st.session_state.pop("dir_trabajo", None)
+    if previo is not None:
+        previo.cleanup()
+    st.session_state["dir_trabajo"] = tempfile.TemporaryDirectory(prefix="distribucion_")
+    return st.session_state["dir_trabajo"].name
+
+
+def escribir_hoja_por_partes(libro, partes, sheet_name, formato_encabezado):
+    """Escribe una hoja de Excel parte a parte y fila a fila (libro xlsxwriter en modo
+    constant_memory), sin juntar las partes en un DataFrame ni retener las celdas.
+    """
+    hoja = libro.add_worksheet(sheet_name)
+    columnas = None
+    fila = 1
+    for parte in partes:
+        parte = parte.drop(columns=["_fila_tareo"], errors="ignore")
+        if columnas is None:
+            columnas = list(parte.columns)
+            hoja.write_row(0, 0, columnas, formato_encabezado)
+        valores = parte.reindex(columns=columnas).astype(object)
+        valores = valores.where(valores.notna(), None)
+        for registro in valores.itertuples(index=False, name=None):
+            hoja.write_row(fila, 0, registro)
+            fila += 1
+
+
+# ---------------- Tablas paginadas ----------------
+def mostrar_tabla_paginada(df, key, filas_por_pagina=(50, 100, 500, 1000)):
+    """Ordena y pagina en el servidor: al navegador solo se envía la página visible
+    (y solo las columnas elegidas), no el DataFrame completo. `df` puede ser una
+    `TablaParquet` (memoria acotada): solo se leen las partes de la página.
+    """
+    en_partes = isinstance(df, TablaParquet)
+    if df is None or df.empty:
+        st.dataframe(pd.DataFrame(columns=df.columns) if en_partes else df, use_container_width=True, hide_index=True)
+        return
+
+    c_orden, c_dir, c_tam, c_pag = st.columns([3, 2, 2, 2])
+    col_orden = c_orden.selectbox("Ordenar por", ["(sin orden)"] + list(df.columns), key=f"{key}_orden")
+    ascendente = c_dir.radio("Dirección", ["Asc", "Desc"], horizontal=True, key=f"{key}_dir") == "Asc"
+    tam = c_tam.selectbox("Filas por página", filas_por_pagina, key=f"{key}_tam")
+    total_paginas = max(1, -(-len(df) // tam))
+    pagina = c_pag.number_input("Página", min_value=1, max_value=total_paginas, value=1, step=1, key=f"{key}_pag")
+
+    columnas = st.multiselect("Columnas", list(df.columns), key=f"{key}_cols", placeholder="Todas las columnas")
+    columnas = columnas or list(df.columns)
+
+    inicio = (int(pagina) - 1) * tam
+    fin = min(inicio + tam, len(df))
+    if col_orden == "(sin orden)":
+        posiciones = np.arange(inicio, fin)
+    else:
+        # Solo se ordena la columna clave; luego se toman las posiciones de la página
+        clave = df.columna(col_orden) if en_partes else df[col_orden].reset_index(drop=True)
+        try:
+            orden = clave.sort_values(ascending=ascendente, kind="mergesort", na_position="last").index
+        except TypeError:
+            orden = clave.astype(str).sort_values(ascending=ascendente, kind="mergesort").index
+        posiciones = orden[inicio:fin]
+    pagina_df = df.tomar(posiciones, columnas) if en_partes else df.iloc[posiciones][columnas]
+
+    st.dataframe(pagina_df, use_container_width=True, hide_index=True)
+    st.caption(f"Filas {inicio + 1:,}–{fin:,} de {len(df):,} · página {int(pagina)} de {total_paginas}")
+
+
+# ---------------- Caché de la sesión ----------------
+def en_cache_de_sesion(nombre, clave, calcular):
+    """Devuelve lo guardado en st.session_state[nombre] si se calculó con la misma `clave`;
+    si no, libera lo anterior, llama a `calcular()` y lo guarda. Así ordenar, paginar o
+    elegir columnas solo recorta resultados ya calculados.
+    """
+    guardado = st.session_state.get(nombre)
+    if guardado is not None and guardado[0] == clave:
+        return guardado[1]
+    del guardado
+    st.session_state.pop(nombre, None)
+    valor = calcular()
+    st.session_state[nombre] = (clave, valor)
+    return valor
+
+
+# ---------------- Filtros y cuadros ----------------
+COLUMNAS_FILTRO = ["AREA", "GRUPO", "FECHA", "APELLIDOS Y NOMBRES", "Validación"]
+
+
+def opciones_de_filtro(df_final):
+    """Combinaciones distintas de las columnas filtrables: alimentan los widgets de la
+    barra lateral sin recorrer el resultado completo en cada ejecución.
+    """
+    return df_final[[c for c in COLUMNAS_FILTRO if c in df_final.columns]].drop_duplicates().reset_index(drop=True)
+
+
+def filtrar(df, filtros):
+    """Aplica los filtros de la barra lateral ({columna: valores elegidos})."""
+    for col, valores in filtros.items():
+        if not valores or col not in df.columns:
+            continue
+        if col == "FECHA" and not isinstance(valores, (list, tuple)):
+            df = df[df["FECHA"] == valores]
+        else:
+            df = df[df[col].isin(valores)]
+    return df
+
+
+def construir_vistas(df_final, filtros, sin_coincidencias):
+    """Arma, para los filtros elegidos, el cuadro con el turno en filas, el cuadro con el
+    turno en columnas, el resultado final y las horas por trabajador de la validación.
+    `df_final` debe traer `_orig_idx`. Con `sin_coincidencias` (los filtros no dejan
+    ninguna fila) el resultado final se muestra completo, como antes.
+    """
+    df_final_filtrado = filtrar(df_final, filtros)
+
+    # ---------------- Transformación a formato largo (Horas por TURNO) ----------------
+    df_filtered = pd.melt(
+        df_final_filtrado,
+        id_vars=[c for c in df_final_filtrado.columns if c not in ["Horas_Dia", "Horas_Noche"]],
+        value_vars=["Horas_Dia", "Horas_Noche"],
+        var_name="TURNO_FINAL",
+        value_name="Horas"
+    )
+
+    df_filtered["TURNO_FINAL"] = df_filtered["TURNO_FINAL"].replace({
+        "Horas_Dia": "DIA",
+        "Horas_Noche": "NOCHE"
+    })
+
+    # ---------------- Limpiar columnas que no queremos mostrar ----------------
+    columnas_excluir = [
+        "TURNO", "EMPRESA", "Área correspondiente",
+        "AREA2", "AREA2_tmp", "C DIA MAQUILA", "C DIA PACKING", "NOCHE MAQUILA", "NOCHE PAC",
+        "Columna1", "SERVICIO DE MAQUILA GTH", "PACKING GTH", "2024", "fecha", "area",
+        "packing", "SERVICIO MAQUILA", "HE_D", "H_NOCTURNAS", "Total de horas",
+        "BONO FRIO", "BONO RESPONSABILIDAD", "BONO MOVILIDAD", "CECO", "_fila_tareo"
+    ]
+    df_filtered = df_filtered.drop(columns=[c for c in columnas_excluir if c in df_filtered.columns], errors="ignore")
+
+    # ---------------- Reordenar columnas para mostrar primer cuadro ----------------
+    if "TURNO_FINAL" in df_filtered.columns:
+        cols = ["TURNO_FINAL"] + [c for c in df_filtered.columns if c != "TURNO_FINAL"]
+    else:
+        cols = list(df_filtered.columns)
+    df_filtered = df_filtered[cols]
+
+    # Reinsertar CECO_FINAL y Horas justo después de APELLIDOS Y NOMBRES si existen
+    if "APELLIDOS Y NOMBRES" in df_filtered.columns and {"CECO_FINAL", "Horas"}.issubset(df_filtered.columns):
+        cols = list(df_filtered.columns)
+        if "CECO_FINAL" in cols:
+            cols.remove("CECO_FINAL")
+        if "Horas" in cols:
+            cols.remove("Horas")
+        if "APELLIDOS Y NOMBRES" in cols:
+            idx = cols.index("APELLIDOS Y NOMBRES") + 1
+            cols = cols[:idx] + ["CECO_FINAL", "Horas"] + cols[idx:]
+            df_filtered = df_filtered[cols]
+
+    # ---------------- Segundo cuadro: resumen sin TURNO_FINAL - Horas_Dia/Horas_Noche ----------------
+    df_third = None
+    if {"FECHA", "APELLIDOS Y NOMBRES", "Horas", "TURNO_FINAL", "CECO_FINAL", "_orig_idx"}.issubset(df_filtered.columns):
+        # Cada fila de df_final aparece una vez por turno: se agrupa por la clave entera _orig_idx
+        # (no por todas las columnas de texto) y las columnas descriptivas se agregan después
+        horas_turno = (
+            df_filtered.groupby(["_orig_idx", "TURNO_FINAL"], sort=False)["Horas"].sum()
+            .unstack("TURNO_FINAL", fill_value=0)
+            .reindex(columns=["DIA", "NOCHE"], fill_value=0)
+            .rename(columns={"DIA": "Horas_Dia", "NOCHE": "Horas_Noche"})
+        )
+        horas_turno.columns.name = None
+
+        descriptivas = (
+            df_filtered.drop(columns=["Horas", "TURNO_FINAL"])
+            .drop_duplicates(subset=["_orig_idx"])
+            .set_index("_orig_idx", drop=False)
+        )
+        df_third = descriptivas.join(horas_turno).reset_index(drop=True)
+
+        # Reubicar Horas_Dia y Horas_Noche justo después de CECO_FINAL
+        cols = [c for c in df_third.columns if c not in ["Horas_Dia", "Horas_Noche"]]
+        idx = cols.index("CECO_FINAL") + 1
+        cols = cols[:idx] + ["Horas_Dia", "Horas_Noche"] + cols[idx:]
+        df_third = df_third[cols]
+
+    # ---------------- Tercer cuadro - Construir resultado final con el orden de columnas solicitado ----------------
+    # Mismas filas que los cuadros anteriores (filtros sincronizados por _orig_idx)
+    out = (df_final if sin_coincidencias else df_final_filtrado).copy()
+    del df_final_filtrado
+
+    # Normalizar nombres de columnas solicitadas. Asegurar existencia:
+    out["AREA"] = out.get("AREA", "")
+    out["GRUPO"] = out.get("GRUPO", "")
+    if "COD" not in out.columns:
+        out["COD"] = out.get("COD", "")
+    if "SEM" not in out.columns:
+        out["SEM"] = out.get("SEM", "")
+    out["FECHA"] = pd.to_datetime(out.get("FECHA"), errors="coerce").dt.date
+    out["CODIGO"] = out.get("CODIGO", "").astype(str).str.strip()
+    out["DESCRIPCION DE LABOR"] = out.get("DESCRIPCION DE LABOR", out.get("Labor", ""))
+    out["CECO_FINAL"] = out.get("CECO_FINAL", "")
+    out["F. INGRESO"] = out.get("F. INGRESO", pd.NaT)
+    out["N° DNI"] = out.get("N° DNI", "").astype(str).str.strip()
+    out["APELLIDOS Y NOMBRES"] = out.get("APELLIDOS Y NOMBRES", "")
+    out["Horas_Dia"] = out.get("Horas_Dia", 0).astype(float) if "Horas_Dia" in out.columns else 0.0
+    out["Horas_Noche"] = out.get("Horas_Noche", 0).astype(float) if "Horas_Noche" in out.columns else 0.0
+    out["ID-ACT"] = out.get("ID-ACT", "").astype(str).str.strip()
+    out["ID-ACT-FINAL"] = out.get("ID-ACT", "").astype(str).str.strip()
+    out["C_LAB"] = out.get("C_LAB", "").astype(str).str.strip()
+    out["TXT DÍA"] = out.get("TXT DÍA", "")
+    out["TXT NOCHE"] = out.get("TXT NOCHE", "")
+
+    final_columns_order = [
+        "AREA", "GRUPO", "COD", "SEM", "FECHA", "CODIGO", "DESCRIPCION DE LABOR",
+        "CECO_FINAL", "F. INGRESO", "N° DNI", "APELLIDOS Y NOMBRES",
+        "Horas_Dia", "Horas_Noche", "ID-ACT-FINAL", "C_LAB", "TXT DÍA", "TXT NOCHE"
+    ]
+
+    for c in final_columns_order:
+        if c not in out.columns:
+            out[c] = ""
+
+    df_result_final = out[final_columns_order].copy()
+    del out
+
+    # asegurar decimales en Horas
+    df_result_final["Horas_Dia"] = df_result_final["Horas_Dia"].fillna(0).astype(float).round(2)
+    df_result_final["Horas_Noche"] = df_result_final["Horas_Noche"].fillna(0).astype(float).round(2)
+
+    # ---------------- Horas por trabajador para el cuadro de validación ----------------
+    horas_validacion = None
+    if set(CLAVE_RESUMEN + ["Horas", "TURNO_FINAL"]).issubset(df_filtered.columns):
+        horas_validacion = df_filtered.groupby(CLAVE_RESUMEN + ["TURNO_FINAL"], dropna=False)["Horas"].sum()
+
+    return df_filtered, df_third, df_result_final, horas_validacion
+
+
+def construir_vistas_por_partes(dir_trabajo, filtros, sin_coincidencias):
+    """`construir_vistas` parte por parte sobre el resultado en parquet (memoria acotada).
+    Los cuadros quedan como tablas parquet en `dir_trabajo/vistas` y las horas de la
+    validación se suman parte a parte; nunca se junta el resultado completo.
+    """
+    carpeta = os.path.join(dir_trabajo, "vistas")
+    shutil.rmtree(carpeta, ignore_errors=True)
+
+    horas_validacion = None
+    hay_turno_en_columnas = True
+    inicio = 0
+    for n, parte in enumerate(iterar_partes(dir_trabajo, "final")):
+        # _orig_idx global: la posición de la fila en el resultado completo
+        parte["_orig_idx"] = range(inicio, inicio + len(parte))
+        inicio += len(parte)
+        if "DESCRIPCION DE LABOR" not in parte.columns:
+            parte["DESCRIPCION DE LABOR"] = ""
+
+        df_filtered, df_third, df_result_final, horas = construir_vistas(parte, filtros, sin_coincidencias)
+        del parte
+        # El melt deja todas las filas DIA antes que las NOCHE: se guardan aparte para que
+        # el cuadro completo quede en el mismo orden que sin partes
+        es_dia = df_filtered["TURNO_FINAL"] == "DIA"
+        escribir_parte(carpeta, "filas_dia", n, df_filtered[es_dia])
+        escribir_parte(carpeta, "filas_noche", n, df_filtered[~es_dia])
+        del df_filtered, es_dia
+        if df_third is None:
+            hay_turno_en_columnas = False
+        else:
+            escribir_parte(carpeta, "columnas", n, df_third)
+            del df_third
+        escribir_parte(carpeta, "resultado", n, df_result_final)
+        del df_result_final
+        horas_validacion = sumar_horas_validacion(horas_validacion, horas)
+
+    return (
+        TablaParquet(carpeta, ["filas_dia", "filas_noche"]),
+        TablaParquet(carpeta, "columnas") if hay_turno_en_columnas else None,
+        TablaParquet(carpeta, "resultado"),
+        horas_validacion,
+    )
+
+
+# ---------------- Exportación ----------------
+def exportar_excel(df_tareo, df_merged, df_result_final, df_summary_tot, df_excepciones, df_third):
+    """Arma el xlsx de descarga (ver `exportar_excel_por_partes` para memoria acotada)."""
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        try:
+            df_tareo.to_excel(writer, index=False, sheet_name="Datos de Usuario GTH")
+        except Exception:
+            pass
+        try:
+            df_result_final.to_excel(writer, index=False, sheet_name="Resumen final (según correo)")
+        except Exception:
+            pass
+        if df_summary_tot is not None:
+            try:
+                df_summary_tot.to_excel(writer, index=False, sheet_name="Validacion")
+            except Exception:
+                pass
+        try:
+            df_excepciones.to_excel(writer, index=False, sheet_name="Excepciones")
+        except Exception:
+            pass
+        if df_third is not None:
+            try:
+                df_third.to_excel(writer, index=False, sheet_name="Resumen - Turno en columnas")
+            except Exception:
+                pass
+        try:
+            df_merged.drop(columns=["_fila_tareo"]).to_excel(writer, index=False, sheet_name="%Kilos de Zupra")
+        except Exception:
+            pass
+    return output.getvalue()
+
+
+def exportar_excel_por_partes(dir_trabajo, df_result_final, df_summary_tot, df_excepciones, df_third):
+    """Arma el xlsx de descarga en memoria acotada: cada hoja se escribe parte por parte
+    desde el parquet (tareo, merge y cuadros `TablaParquet`) con xlsxwriter en modo
+    constant_memory, directo a un archivo en `dir_trabajo`. Devuelve su ruta.
+    """
+    ruta = os.path.join(dir_trabajo, "exportacion.xlsx")
+    libro = xlsxwriter.Workbook(ruta, {"constant_memory": True, "default_date_format": "yyyy-mm-dd"})
+    encabezado = libro.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    hojas = [
+        ("Datos de Usuario GTH", iterar_partes(dir_trabajo, "tareo")),
+        ("Resumen final (según correo)", df_result_final.partes()),
+        ("Validacion", None if df_summary_tot is None else [df_summary_tot]),
+        ("Excepciones", [df_excepciones]),
+        ("Resumen - Turno en columnas", None if df_third is None else df_third.partes()),
+        ("%Kilos de Zupra", iterar_partes(dir_trabajo, "merged")),
+    ]
+    try:
+        for nombre, partes in hojas:
+            if partes is not None:
+                escribir_hoja_por_partes(libro, partes, nombre, encabezado)
+    finally:
+        libro.close()
+    return ruta
+
+
+def leer_archivo(ruta):
+    with open(ruta, "rb") as f:
+        return f.read()
+
+
 # ---------------- Interfaz ----------------
 st.title("📊 Distribución de horas según porcentajes de kilos ZUPRA")
+
+# ---------------- Ejecución (barra lateral) ----------------
+st.sidebar.header("⚙️ Ejecución")
+modo_ejecucion = st.sidebar.selectbox(
+    "Modo de ejecución", ["Secuencial", "Paralelo por FECHA", "Paralelo por SEM"],
+    help="Los modos paralelos procesan cada fecha o semana en un proceso distinto."
+)
+n_procesos = os.cpu_count() or 1
+if modo_ejecucion != "Secuencial":
+    n_procesos = st.sidebar.number_input("Procesos", min_value=1, max_value=n_procesos, value=n_procesos, step=1)
+modo_delta = st.sidebar.checkbox(
+    "Modo delta", value=False,
+    help="Al volver a subir un tareo corregido, recalcula solo las filas agregadas o modificadas."
+)
+modo_memoria = st.sidebar.checkbox(
+    "Memoria acotada", value=False,
+    help="Procesa el tareo por lotes y guarda los resultados intermedios en disco (parquet). Para libros muy grandes."
+)
+presupuesto_mb = None
+if modo_memoria:
+    presupuesto_mb = st.sidebar.number_input("Presupuesto de memoria (MB)", min_value=64, value=512, step=64)
+    if modo_delta:
+        st.sidebar.caption("El modo delta no se aplica con memoria acotada.")
+recalcular = st.sidebar.button(
+    "🔄 Volver a calcular",
+    help="Vuelve a leer Postgres y los maestros y a procesar el archivo. Ordenar, paginar o filtrar no recalcula."
+)
 uploaded_file = st.file_uploader("Sube la estructura correcta en excel", type=["xlsx"]) 
 
-if uploaded_file:
+
+
+def calcular_distribucion(uploaded_file, modo_ejecucion, n_procesos, modo_delta, modo_memoria, presupuesto_mb):
+    """Lee el libro, consulta Postgres y aplica el pipeline. Es la parte cara de la app:
+    el resultado se guarda en la sesión y solo se recalcula con otro archivo, otras
+    opciones de ejecución o con "Volver a calcular".
+    """
     # ---------------- Leer hojas ----------------
-    xls = pd.read_excel(uploaded_file, sheet_name=None)
-    # Normalizamos nombres de hojas a mayúsculas sin espacios alrededor
-    sheets = {k.strip().upper(): v for k, v in xls.items()}
+    NOMBRES_TAREO = ["TAREO PACKING", "TAREO_PACKING", "TAREO"]
+    NOMBRES_DNI = ["DNI"]
+    NOMBRES_LABORES = ["LABORES", "LABOR", "ACTIVIDADES"]
+
+    if modo_memoria:
+        # Solo DNI y LABORES se cargan completas; el tareo se lee por lotes más abajo
+        nombres_hojas = {n.strip().upper(): n for n in nombres_de_hojas(uploaded_file)}
+        hoja_tareo = next((nombres_hojas[n] for n in NOMBRES_TAREO if n in nombres_hojas), None)
+        sheets = {
+            k: pd.read_excel(uploaded_file, sheet_name=n)
+            for k, n in nombres_hojas.items() if k in NOMBRES_DNI + NOMBRES_LABORES
+        }
+    else:
+        xls = pd.read_excel(uploaded_file, sheet_name=None)
+        # Normalizamos nombres de hojas a mayúsculas sin espacios alrededor
+        sheets = {k.strip().upper(): v for k, v in xls.items()}
+        del xls
 
     # Buscar hoja por nombres posibles (tolerante a variantes)
-    def get_sheet_by_name(possible_names):
+    def get_sheet_by_name(sheets, possible_names):
         for name in possible_names:
             if name.strip().upper() in sheets:
                 return sheets[name.strip().upper()].copy()
         return pd.DataFrame()
 
-    df_tareo = get_sheet_by_name(["TAREO PACKING", "TAREO_PACKING", "TAREO"])
-    df_dni = get_sheet_by_name(["DNI"])
-    df_labores = get_sheet_by_name(["LABORES", "LABOR", "ACTIVIDADES"])    
+    df_tareo = get_sheet_by_name(sheets, NOMBRES_TAREO)
+    df_dni = get_sheet_by_name(sheets, NOMBRES_DNI)
+    df_labores = get_sheet_by_name(sheets, NOMBRES_LABORES)
+    del sheets
 
     # Si alguna hoja está vacía, creamos df vacío con columnas mínimas para evitar errores posteriores
     if df_tareo is None or df_tareo.empty:
@@ -78,43 +529,7 @@ if uploaded_file:
             df.columns = [str(c).strip() for c in df.columns]
 
     # ---------------- Normalización TAREO ----------------
-    # Aseguramos columna DNI en tareo con nombre estándar "N° DNI"
-    if "N° DNI" in df_tareo.columns:
-        df_tareo["N° DNI"] = df_tareo["N° DNI"].astype(str).str.strip()
-    elif "N°DNI" in df_tareo.columns:
-        df_tareo["N° DNI"] = df_tareo["N°DNI"].astype(str).str.strip()
-    else:
-        possible = [c for c in df_tareo.columns if "DNI" in c.upper()]
-        if possible:
-            df_tareo["N° DNI"] = df_tareo[possible[0]].astype(str).str.strip()
-        else:
-            df_tareo["N° DNI"] = ""
-
-    # Campos FECHA
-    if "FECHA" in df_tareo.columns:
-        df_tareo["FECHA"] = pd.to_datetime(df_tareo["FECHA"], errors="coerce").dt.date
-    elif "F. INGRESO" in df_tareo.columns:
-        df_tareo["FECHA"] = pd.to_datetime(df_tareo["F. INGRESO"], errors="coerce").dt.date
-    else:
-        # intentar encontrar alguna columna fecha
-        possible_fecha = [c for c in df_tareo.columns if "FECHA" in c.upper()]
-        if possible_fecha:
-            df_tareo["FECHA"] = pd.to_datetime(df_tareo[possible_fecha[0]], errors="coerce").dt.date
-        else:
-            df_tareo["FECHA"] = pd.NaT
-
-    # Aseguramos columnas que usaremos y convertimos a string cuando corresponda
-    def ensure_cols_exist(df, cols):
-        for col in cols:
-            if col not in df.columns:
-                df[col] = ""
-
-    ensure_cols_exist(df_tareo, ["AREA","GRUPO","COD","SEM","CODIGO","DESCRIPCION DE LABOR","CECO","HE_D","H_NOCTURNAS","APELLIDOS Y NOMBRES"])
-
-    # Convertir a string columnas relevantes
-    for c in ["AREA","CECO","CODIGO"]:
-        if c in df_tareo.columns:
-            df_tareo[c] = df_tareo[c].astype(str).str.strip()
+    df_tareo = normalizar_tareo(df_tareo)
 
     # ---------------- Normalización DNI ----------------
     if "DNI" in df_dni.columns:
@@ -181,8 +596,17 @@ if uploaded_file:
     else:
         df_labores["COD_LABOR"] = df_labores.get("C_LAB", "").astype(str).str.strip()
 
+    # ---------------- Maestros compartidos (DNI / LABORES) ----------------
+    # Las hojas subidas se aplican como delta; los joins usan la versión vigente del maestro
+    version_maestros, df_dni, df_labores = get_maestros().aplicar(df_dni, df_labores)
+    aviso_maestros = f"Maestros v{version_maestros}: {len(df_dni):,} DNI · {len(df_labores):,} labores"
+
     # ---------------- Asegurar columnas packing / maquila en df_postgres mapping ----------------
-    df_postgres = get_postgres_data()
+    df_postgres, stats_postgres = get_postgres_data()
+    aviso_postgres = (
+        f"Postgres: {stats_postgres['filas']:,} filas · {stats_postgres['bytes'] / 1024:,.1f} KB transferidos · "
+        f"fetch {stats_postgres['segundos_fetch']:.2f} s (total {stats_postgres['segundos_total']:.2f} s)"
+    )
     # Normalizar df_postgres cuando existen columnas con distintos nombres
     if "fecha" in df_postgres.columns:
         df_postgres["fecha"] = pd.to_datetime(df_postgres["fecha"], errors="coerce").dt.date
@@ -226,254 +650,80 @@ if uploaded_file:
     else:
         df_postgres["SERVICIO MAQUILA"] = pd.to_numeric(df_postgres["SERVICIO MAQUILA"], errors="coerce").fillna(0)
 
-    # ---------------- Preparar TAREO para merges ----------------
-    # CECO/AREA
-    if "AREA" in df_tareo.columns:
-        df_tareo["AREA"] = df_tareo["AREA"].astype(str).str.strip()
-    else:
-        df_tareo["AREA"] = ""
-
-    if "CECO" in df_tareo.columns:
-        df_tareo["CECO"] = df_tareo["CECO"].astype(str).str.strip()
-    else:
-        df_tareo["CECO"] = "Sin CECO"
-
-    # Crear AREA2_tmp igual que script original (mapear AREA)
-    def map_area(area):
-        a = str(area).strip().upper()
-        if a in ["OBRAS EN CURSO", "GESTION DEL TALENTO HUMANO", "SSOMA"]:
-            return "NO"
-        elif a in ["PRODUCCION", "ALMACEN DE PISO PRODUCCION"]:
-            return "PRODUCCION"
-        else:
-            return "RECEPCION"
-
-    df_tareo["AREA2_tmp"] = df_tareo["AREA"].apply(map_area)
-
-    # ---------------- Merge TAREO con POSTGRES ----------------
-    df_tareo_for_merge = df_tareo.copy()
-    # aseguramos FECHA en df_tareo_for_merge
-    if "FECHA" not in df_tareo_for_merge.columns or df_tareo_for_merge["FECHA"].isnull().all():
-        possible_fecha = [c for c in df_tareo_for_merge.columns if "FECHA" in c.upper()]
-        if possible_fecha:
-            df_tareo_for_merge["FECHA"] = pd.to_datetime(df_tareo_for_merge[possible_fecha[0]], errors="coerce").dt.date
-        else:
-            df_tareo_for_merge["FECHA"] = pd.NaT
-
+    # ---------------- Merge, distribución, joins y TXT ----------------
     df_postgres_lookup = df_postgres.copy()
     df_postgres_lookup["fecha"] = pd.to_datetime(df_postgres_lookup["fecha"], errors="coerce").dt.date
     df_postgres_lookup["area"] = df_postgres_lookup["area"].astype(str).str.strip().str.upper()
 
-    df_tareo_for_merge["AREA2_tmp_UP"] = df_tareo_for_merge["AREA2_tmp"].astype(str).str.strip().str.upper()
-    df_tareo_for_merge["FECHA"] = pd.to_datetime(df_tareo_for_merge["FECHA"], errors="coerce").dt.date
-
-    # Intentar merge con la columna normalizada
-    left_on_cols = ["FECHA", "AREA2_tmp_UP"] if "AREA2_tmp_UP" in df_tareo_for_merge.columns else ["FECHA", "AREA2_tmp"]
-
-    df_merged = pd.merge(
-        df_tareo_for_merge,
-        df_postgres_lookup,
-        left_on=left_on_cols,
-        right_on=["fecha", "area"],
-        how="left",
-        suffixes=("_tareo", "_pg")
-    )
-
-    # ---------------- Aplicar la lógica de descomposición y distribución de horas ----------------
-    registros_finales = []
-
-    # Iteramos cada fila del merge y aplicamos reglas de negocio
-    for _, row in df_merged.iterrows():
-        he_d = row.get("HE_D", 0) or 0
-        h_noche = row.get("H_NOCTURNAS", 0) or 0
-        try:
-            packing = float(row.get("packing", 0) or 0)
-        except:
-            packing = 0.0
-        try:
-            maquila = float(row.get("SERVICIO MAQUILA", 0) or 0)
-        except:
-            maquila = 0.0
-
-        area_val = str(row.get("AREA", "")).strip()
-        ceco_val = str(row.get("CECO", "Sin CECO")).strip()
-
-        # CASOS según la lógica original
-        if area_val in ["OBRAS EN CURSO", "GESTION DEL TALENTO HUMANO", "SSOMA"]:
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": ceco_val,
-                "Horas_Dia": round(float(he_d), 2),
-                "Horas_Noche": round(float(h_noche), 2)
-            })
-        elif area_val in ["PRODUCCION", "ALMACEN DE PISO PRODUCCION"]:
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": "PROCESO_PACK",
-                "Horas_Dia": round(float(he_d * packing), 2),
-                "Horas_Noche": round(float(h_noche * packing), 2)
-            })
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": "SERV_MAQUILA",
-                "Horas_Dia": round(float(he_d * maquila), 2),
-                "Horas_Noche": round(float(h_noche * maquila), 2)
-            })
-        elif ceco_val == "RECEP_PACK":
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": "RECEP_PACK",
-                "Horas_Dia": round(float(he_d * packing), 2),
-                "Horas_Noche": round(float(h_noche * packing), 2)
-            })
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": "SERV_MAQUILA",
-                "Horas_Dia": round(float(he_d * maquila), 2),
-                "Horas_Noche": round(float(h_noche * maquila), 2)
-            })
-        else:
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": ceco_val,
-                "Horas_Dia": round(float(he_d * packing), 2),
-                "Horas_Noche": round(float(h_noche * packing), 2)
-            })
-            registros_finales.append({
-                **row,
-                "CECO_FINAL": "SERV_MAQUILA",
-                "Horas_Dia": round(float(he_d * maquila), 2),
-                "Horas_Noche": round(float(h_noche * maquila), 2)
-            })
-
-    df_final = pd.DataFrame(registros_finales)
-
-    # Asegurar Horas_Dia/Noche
-    if not df_final.empty:
-        df_final["Horas_Dia"] = df_final.get("Horas_Dia", 0).fillna(0).astype(float)
-        df_final["Horas_Noche"] = df_final.get("Horas_Noche", 0).fillna(0).astype(float)
+    if modo_ejecucion == "Secuencial":
+        procesar = procesar_distribucion
     else:
-        df_final["Horas_Dia"] = pd.Series(dtype=float)
-        df_final["Horas_Noche"] = pd.Series(dtype=float)
-
-    # ---------------- Join con hoja DNI para traer FECHA_INGRESO y APELLIDOS ----------------
-    df_final["N° DNI"] = df_final.get("N° DNI", df_final.get("N°DNI", "")).astype(str).str.strip()
-    df_dni["DNI"] = df_dni["DNI"].astype(str).str.strip() if "DNI" in df_dni.columns else df_dni["DNI"]
-
-    if not df_final.empty and not df_dni.empty:
-        df_final = pd.merge(
-            df_final,
-            df_dni[["DNI", "FECHA_INGRESO", "APELLIDOS"]].drop_duplicates(subset=["DNI"]),
-            left_on="N° DNI",
-            right_on="DNI",
-            how="left",
-            suffixes=("", "_dni")
+        procesar = partial(
+            procesar_por_shards,
+            por="SEM" if modo_ejecucion.endswith("SEM") else "FECHA",
+            pool=get_pool_compartido(),
+            max_workers=n_procesos
         )
-    else:
-        # Asegurar columnas si el merge no se hizo
-        if "FECHA_INGRESO" not in df_final.columns:
-            df_final["FECHA_INGRESO"] = pd.NaT
-        if "APELLIDOS" not in df_final.columns:
-            df_final["APELLIDOS"] = ""
-
-    # ---------------- Join con hoja LABORES (por CODIGO) ----------------
-    if "CODIGO" in df_final.columns:
-        df_final["CODIGO"] = df_final["CODIGO"].astype(str).str.strip()
-    else:
-        if "COD" in df_final.columns:
-            df_final["CODIGO"] = df_final["COD"].astype(str).str.strip()
+
+    aviso_proceso = None
+    dir_trabajo = None
+    if modo_memoria:
+        dir_trabajo = nuevo_directorio_trabajo()
+        if hoja_tareo is None:
+            resumen_memoria = {"filas": 0, "lotes": 0, "filas_por_lote": None}
         else:
-            df_final["CODIGO"] = ""
-
-    df_labores["CODIGO"] = df_labores.get("CODIGO", pd.Series(dtype=str)).astype(str).str.strip()
-
-    if not df_labores.empty and not df_final.empty:
-        df_final = pd.merge(
-            df_final,
-            df_labores[["CODIGO", "Labor", "ID_ACTIVIDAD", "COD_LABOR"]].drop_duplicates(subset=["CODIGO"]),
-            left_on="CODIGO",
-            right_on="CODIGO",
-            how="left",
-            suffixes=("", "_lab")
+            resumen_memoria = procesar_fuera_de_memoria(
+                uploaded_file, hoja_tareo, df_postgres_lookup, df_dni, df_labores, dir_trabajo,
+                presupuesto_mb=presupuesto_mb, procesar=procesar
+            )
+        aviso_proceso = (
+            f"Memoria acotada: {resumen_memoria['filas']:,} filas del tareo en {resumen_memoria['lotes']:,} lotes "
+            f"de hasta {resumen_memoria['filas_por_lote'] or 0:,} filas"
+        )
+        if resumen_memoria.get("bytes_por_fila"):
+            aviso_proceso += f" ({resumen_memoria['bytes_por_fila'] / 1024:,.1f} KB por fila medidos)"
+
+        # Validación y opciones de filtro parte por parte: solo se guardan los agregados
+        agregados, opciones = None, None
+        for parte_tareo, parte_merged, parte_final in zip(
+            iterar_partes(dir_trabajo, "tareo", columnas=["N° DNI", "FECHA", "AREA", "HE_D", "H_NOCTURNAS"]),
+            iterar_partes(dir_trabajo, "merged", columnas=["FECHA", "AREA", "AREA2_tmp", "packing", "SERVICIO MAQUILA"]),
+            iterar_partes(dir_trabajo, "final"),
+        ):
+            agregados = combinar_agregados(agregados, agregados_validacion(parte_tareo, parte_merged, parte_final))
+            opciones_parte = opciones_de_filtro(parte_final)
+            opciones = opciones_parte if opciones is None else (
+                pd.concat([opciones, opciones_parte], ignore_index=True).drop_duplicates(ignore_index=True)
+            )
+        return {
+            "df_tareo": None,
+            "df_merged": None,
+            "df_final": None,
+            "df_excepciones": excepciones_de(agregados or {"pct": None, "origen": None, "distribuido": None}),
+            "opciones": opciones if opciones is not None else pd.DataFrame(columns=COLUMNAS_FILTRO),
+            "dir_trabajo": dir_trabajo,
+            "aviso_maestros": aviso_maestros,
+            "aviso_postgres": aviso_postgres,
+            "aviso_proceso": aviso_proceso,
+        }
+    elif modo_delta:
+        # Los resultados previos solo sirven con los mismos porcentajes y la misma versión de maestros
+        firma = (version_maestros, int(pd.util.hash_pandas_object(df_postgres_lookup.astype(str)).sum()))
+        df_merged, df_final, st.session_state["delta_tareo"], resumen_delta = procesar_delta(
+            df_tareo, df_postgres_lookup, df_dni, df_labores, firma,
+            previo=st.session_state.get("delta_tareo"), procesar=procesar
+        )
+        aviso_proceso = (
+            f"Modo delta: {resumen_delta['agregadas']:,} filas agregadas · {resumen_delta['modificadas']:,} modificadas · "
+            f"{resumen_delta['eliminadas']:,} eliminadas · {resumen_delta['reutilizadas']:,} reutilizadas"
         )
     else:
-        if "Labor" not in df_final.columns:
-            df_final["Labor"] = ""
-        if "ID_ACTIVIDAD" not in df_final.columns:
-            df_final["ID_ACTIVIDAD"] = ""
-        if "COD_LABOR" not in df_final.columns:
-            df_final["COD_LABOR"] = ""
-
-    # Asegurarnos de que ID_ACTIVIDAD y COD_LABOR sean texto y sin decimales
-    if "ID_ACTIVIDAD" in df_final.columns:
-        df_final["ID_ACTIVIDAD"] = df_final["ID_ACTIVIDAD"].apply(lambda x:"0"+ str(x).split(".")[0] if pd.notna(x) else "")
-    else:
-        df_final["ID_ACTIVIDAD"] = ""
-    if "COD_LABOR" in df_final.columns:
-        df_final["COD_LABOR"] = df_final["COD_LABOR"].apply(lambda x: safe_str(x))
-    else:
-        df_final["COD_LABOR"] = ""
-
-    # Normalizar FECHA_INGRESO -> "F. INGRESO"
-    if "FECHA_INGRESO" in df_final.columns:
-        df_final["F. INGRESO"] = df_final["FECHA_INGRESO"]
-    elif "F. INGRESO" in df_final.columns:
-        df_final["F. INGRESO"] = pd.to_datetime(df_final["F. INGRESO"], errors="coerce").dt.date
-    else:
-        df_final["F. INGRESO"] = pd.NaT
-
-    # APELLIDOS Y NOMBRES
-    if "APELLIDOS" in df_final.columns and df_final["APELLIDOS"].notna().any():
-        df_final["APELLIDOS Y NOMBRES"] = df_final["APELLIDOS"]
-    else:
-        if "APELLIDOS Y NOMBRES" in df_final.columns:
-            df_final["APELLIDOS Y NOMBRES"] = df_final["APELLIDOS Y NOMBRES"]
-        else:
-            df_final["APELLIDOS Y NOMBRES"] = ""
-
-    # ID-ACT y C_LAB (asegurando texto)
-
-    df_final["ID-ACT"] = df_final.get("ID_ACTIVIDAD", "").apply(lambda x: str(x).split(".")[0] if pd.notna(x) else "")
-    df_final["C_LAB"] = df_final.get("COD_LABOR", "").apply(lambda x: str(x).split(".")[0] if pd.notna(x) else "")
-
-
-
-    # ---------------- Asegurar que exista DESCRIPCION DE LABOR para mostrarse en los cuadros ----------------
-    # Llenamos "DESCRIPCION DE LABOR" desde la columna Labor si existe
-    df_final["DESCRIPCION DE LABOR"] = df_final.get("Labor", df_final.get("DESCRIPCION DE LABOR", ""))
+        st.session_state.pop("delta_tareo", None)
+        df_merged, df_final = procesar(df_tareo, df_postgres_lookup, df_dni, df_labores)
 
-    # ---------------- Generar TXT DÍA / TXT NOCHE ----------------
-    df_final["FECHA"] = pd.to_datetime(df_final.get("FECHA"), errors="coerce").dt.date
+    # ---------------- Validación contra el tareo original ----------------
+    df_excepciones = validar_distribucion(df_tareo, df_merged, df_final)
 
-    def build_txt_row(row, turno="DIA"):
-        fecha = row.get("FECHA")
-        if pd.isna(fecha):
-            year = ""
-            month = ""
-            day = ""
-        else:
-            year = fecha.year
-            month = "{:02d}".format(fecha.month)
-            day = "{:02d}".format(fecha.day)
-        codigo_turno = "01" if turno == "DIA" else "03"
-        dni = safe_str(row.get("N° DNI"))
-        # usar ID-ACT ya normalizado como texto
-        id_act = safe_str(row.get("ID-ACT"))
-        c_lab = safe_str(row.get("C_LAB"))
-        ceco = safe_str(row.get("CECO_FINAL"))
-        horas = row.get("Horas_Dia", 0) if turno == "DIA" else row.get("Horas_Noche", 0)
-        minutos = int(round(float(horas or 0) * 60))
-        txt = f"0002|{year}{month}{day}|000004|{codigo_turno}|{dni}|{id_act}|{c_lab}|{ceco}|{minutos}|"
-        return txt
-
-    # Antes de aplicar build_txt_row, garantizar que ID-ACT y C_LAB estén como texto sin .0
-    df_final["ID-ACT"] = df_final["ID-ACT"].apply(lambda x: safe_str(x))
-    df_final["C_LAB"] = df_final["C_LAB"].apply(lambda x: safe_str(x))
-
-    df_final["TXT DÍA"] = df_final.apply(lambda r: build_txt_row(r, "DIA"), axis=1)
-    df_final["TXT NOCHE"] = df_final.apply(lambda r: build_txt_row(r, "NOCHE"), axis=1)
-
-    # ---------------- Transformación a formato largo (Horas por TURNO) ----------------
     # Guardamos un identificador original para poder mapear filtros al resultado final
     df_final = df_final.reset_index(drop=True)
     df_final["_orig_idx"] = df_final.index
@@ -482,223 +732,110 @@ if uploaded_file:
     if "DESCRIPCION DE LABOR" not in df_final.columns:
         df_final["DESCRIPCION DE LABOR"] = ""
 
-    df_long = pd.melt(
-        df_final,
-        id_vars=[c for c in df_final.columns if c not in ["Horas_Dia", "Horas_Noche"]],
-        value_vars=["Horas_Dia", "Horas_Noche"],
-        var_name="TURNO_FINAL",
-        value_name="Horas"
+    return {
+        "df_tareo": df_tareo,
+        "df_merged": df_merged,
+        "df_final": df_final,
+        "df_excepciones": df_excepciones,
+        "opciones": opciones_de_filtro(df_final),
+        "dir_trabajo": dir_trabajo,
+        "aviso_maestros": aviso_maestros,
+        "aviso_postgres": aviso_postgres,
+        "aviso_proceso": aviso_proceso,
+    }
+
+
+if uploaded_file:
+    # ---------------- Procesamiento (guardado en la sesión) ----------------
+    clave_calculo = (
+        hashlib.sha256(uploaded_file.getvalue()).hexdigest(),
+        modo_ejecucion, n_procesos, modo_delta, modo_memoria, presupuesto_mb
+    )
+    if recalcular:
+        for nombre in ["calculo", "vistas", "exportacion"]:
+            st.session_state.pop(nombre, None)
+    calculo = en_cache_de_sesion("calculo", clave_calculo, lambda: calcular_distribucion(
+        uploaded_file, modo_ejecucion, n_procesos, modo_delta, modo_memoria, presupuesto_mb
+    ))
+    df_tareo, df_merged, df_final, df_excepciones = (
+        calculo[k] for k in ["df_tareo", "df_merged", "df_final", "df_excepciones"]
     )
 
-    df_long["TURNO_FINAL"] = df_long["TURNO_FINAL"].replace({
-        "Horas_Dia": "DIA",
-        "Horas_Noche": "NOCHE"
-    })
+    st.sidebar.caption(calculo["aviso_maestros"])
+    st.caption(calculo["aviso_postgres"])
+    if calculo["aviso_proceso"]:
+        st.info(calculo["aviso_proceso"])
 
     # ---------------- FILTROS (barra lateral) ----------------
     st.sidebar.header("🔎 Filtros")
 
-    df_filtered = df_long.copy()
+    # Las opciones de cada filtro salen de las combinaciones distintas ya calculadas,
+    # encadenadas igual que antes (cada filtro acota las opciones del siguiente)
+    opciones = calculo["opciones"]
 
     # Variables para guardar los filtros que aplicaremos también al resultado final
     applied_filters = {}
 
     # Area (Excel)
-    if "AREA" in df_filtered.columns:
-        area_excel_filter = st.sidebar.multiselect("Área", sorted(df_filtered["AREA"].dropna().unique()))
+    if "AREA" in opciones.columns:
+        area_excel_filter = st.sidebar.multiselect("Área", sorted(opciones["AREA"].dropna().unique()))
         applied_filters['AREA'] = area_excel_filter
-        if area_excel_filter:
-            df_filtered = df_filtered[df_filtered["AREA"].isin(area_excel_filter)]
+        opciones = filtrar(opciones, {"AREA": area_excel_filter})
 
     # Grupo
-    if "GRUPO" in df_filtered.columns:
-        grupo_filter = st.sidebar.multiselect("Grupo", sorted(df_filtered["GRUPO"].dropna().unique()))
+    if "GRUPO" in opciones.columns:
+        grupo_filter = st.sidebar.multiselect("Grupo", sorted(opciones["GRUPO"].dropna().unique()))
         applied_filters['GRUPO'] = grupo_filter
-        if grupo_filter:
-            df_filtered = df_filtered[df_filtered["GRUPO"].isin(grupo_filter)]
+        opciones = filtrar(opciones, {"GRUPO": grupo_filter})
 
     # Fecha filter (rango / single)
-    try:
-        fecha_min = df_filtered["FECHA"].min()
-        fecha_max = df_filtered["FECHA"].max()
-    except:
-        fecha_min = None
-        fecha_max = None
-
     fecha_filter = st.sidebar.date_input("Fecha", [])
     applied_filters['FECHA'] = fecha_filter
-    if fecha_filter:
-        if isinstance(fecha_filter, (list, tuple)):
-            df_filtered = df_filtered[df_filtered["FECHA"].isin(fecha_filter)]
-        else:
-            df_filtered = df_filtered[df_filtered["FECHA"] == fecha_filter
-                                       ]
+    opciones = filtrar(opciones, {"FECHA": fecha_filter})
 
     # Nombre filter
-    if "APELLIDOS Y NOMBRES" in df_filtered.columns:
-        nombre_filter = st.sidebar.multiselect("Nombres", sorted(df_filtered["APELLIDOS Y NOMBRES"].dropna().unique()))
+    if "APELLIDOS Y NOMBRES" in opciones.columns:
+        nombre_filter = st.sidebar.multiselect("Nombres", sorted(opciones["APELLIDOS Y NOMBRES"].dropna().unique()))
         applied_filters['APELLIDOS Y NOMBRES'] = nombre_filter
-        if nombre_filter:
-            df_filtered = df_filtered[df_filtered["APELLIDOS Y NOMBRES"].isin(nombre_filter)]
+        opciones = filtrar(opciones, {"APELLIDOS Y NOMBRES": nombre_filter})
 
     # Validación filter (solo si existe campo)
-    if "Validación" in df_filtered.columns:
-        val_filter = st.sidebar.multiselect("Validación", sorted(df_filtered["Validación"].dropna().unique()))
+    if "Validación" in opciones.columns:
+        val_filter = st.sidebar.multiselect("Validación", sorted(opciones["Validación"].dropna().unique()))
         applied_filters['Validación'] = val_filter
-        if val_filter:
-            df_filtered = df_filtered[df_filtered["Validación"].isin(val_filter)]
-
-    # ---------------- Limpiar columnas que no queremos mostrar ----------------
-    columnas_excluir = [
-        "TURNO", "EMPRESA", "Área correspondiente",
-        "AREA2", "AREA2_tmp", "C DIA MAQUILA", "C DIA PACKING", "NOCHE MAQUILA", "NOCHE PAC",
-        "Columna1", "SERVICIO DE MAQUILA GTH", "PACKING GTH", "2024", "fecha", "area",
-        "packing", "SERVICIO MAQUILA", "HE_D", "H_NOCTURNAS", "Total de horas",
-        "BONO FRIO", "BONO RESPONSABILIDAD", "BONO MOVILIDAD", "CECO"
-    ]
-    df_filtered = df_filtered.drop(columns=[c for c in columnas_excluir if c in df_filtered.columns], errors="ignore")
-
-    # ---------------- Reordenar columnas para mostrar primer cuadro ----------------
-    if "TURNO_FINAL" in df_filtered.columns:
-        cols = ["TURNO_FINAL"] + [c for c in df_filtered.columns if c != "TURNO_FINAL"]
+        opciones = filtrar(opciones, {"Validación": val_filter})
+
+    # ---------------- Cuadros (guardados en la sesión por conjunto de filtros) ----------------
+    clave_filtros = repr(sorted(applied_filters.items()))
+    if calculo["dir_trabajo"]:
+        # Memoria acotada: los cuadros quedan en parquet y se paginan desde ahí
+        construir = partial(
+            construir_vistas_por_partes, calculo["dir_trabajo"], applied_filters, sin_coincidencias=opciones.empty
+        )
     else:
-        cols = list(df_filtered.columns)
-    df_filtered = df_filtered[cols]
-
-    # Reinsertar CECO_FINAL y Horas justo después de APELLIDOS Y NOMBRES si existen
-    if "APELLIDOS Y NOMBRES" in df_filtered.columns and {"CECO_FINAL", "Horas"}.issubset(df_filtered.columns):
-        cols = list(df_filtered.columns)
-        if "CECO_FINAL" in cols:
-            cols.remove("CECO_FINAL")
-        if "Horas" in cols:
-            cols.remove("Horas")
-        if "APELLIDOS Y NOMBRES" in cols:
-            idx = cols.index("APELLIDOS Y NOMBRES") + 1
-            cols = cols[:idx] + ["CECO_FINAL", "Horas"] + cols[idx:]
-            df_filtered = df_filtered[cols]
+        construir = partial(construir_vistas, df_final, applied_filters, sin_coincidencias=opciones.empty)
+    df_filtered, df_third, df_result_final, horas_validacion = en_cache_de_sesion(
+        "vistas", (clave_calculo, clave_filtros), construir
+    )
 
     # ---------------- Primer cuadro: resultados distribuidos (long) ----------------
     st.subheader("📋 Resumen - Turno en filas")
-    st.dataframe(df_filtered, use_container_width=True, hide_index=True)
-
-    # ---------------- Segundo cuadro: resumen sin TURNO_FINAL (pivot) - Horas_Dia/Horas_Noche ----------------
-    df_third = None
-    if {"FECHA", "APELLIDOS Y NOMBRES", "Horas", "TURNO_FINAL", "CECO_FINAL"}.issubset(df_filtered.columns):
-        pivot_index = [c for c in df_filtered.columns if c not in ["Horas", "TURNO_FINAL"]]
-        try:
-            df_third = df_filtered.pivot_table(
-                index=pivot_index,
-                columns="TURNO_FINAL",
-                values="Horas",
-                aggfunc="sum",
-                fill_value=0
-            ).reset_index()
-
-            # Renombrar columnas DÍA/NOCHE
-            if "DIA" in df_third.columns:
-                df_third = df_third.rename(columns={"DIA": "Horas_Dia"})
-            if "NOCHE" in df_third.columns:
-                df_third = df_third.rename(columns={"NOCHE": "Horas_Noche"})
-
-            # Reubicar Horas_Dia y Horas_Noche justo después de CECO_FINAL
-            if "CECO_FINAL" in df_third.columns:
-                cols = list(df_third.columns)
-                for c in ["Horas_Dia", "Horas_Noche"]:
-                    if c in cols:
-                        cols.remove(c)
-                idx = cols.index("CECO_FINAL") + 1
-                cols = cols[:idx] + ["Horas_Dia", "Horas_Noche"] + cols[idx:]
-                df_third = df_third[cols]
-
-            st.subheader("📊 Resumen - Turno en columnas")
-            st.dataframe(df_third, use_container_width=True, hide_index=True)
-        except Exception as e:
-            st.warning(f"No fue posible pivotear el dataframe: {e}")
-            df_third = None
-
-
-    # ---------------- SINCRONIZAR FILTROS CON 'RESULTADO FINAL' ----------------
-    if "_orig_idx" in df_filtered.columns:
-        orig_idx_set = df_filtered["_orig_idx"].unique().tolist()
-    else:
-        orig_idx_set = []
-
-    # ---------------- Tercer cuadro - Construir resultado final con el orden de columnas solicitado ----------------
-    out = df_final.copy()
-
-    # Aplicar filtro de _orig_idx al resultado final para sincronizar
-    if orig_idx_set:
-        out = out[out["_orig_idx"].isin(orig_idx_set)].copy()
+    mostrar_tabla_paginada(df_filtered, key="tabla_filas")
 
-    # Normalizar nombres de columnas solicitadas. Asegurar existencia:
-    out["AREA"] = out.get("AREA", "")
-    out["GRUPO"] = out.get("GRUPO", "")
-    if "COD" not in out.columns:
-        out["COD"] = out.get("COD", "")
-    if "SEM" not in out.columns:
-        out["SEM"] = out.get("SEM", "")
-    out["FECHA"] = pd.to_datetime(out.get("FECHA"), errors="coerce").dt.date
-    out["CODIGO"] = out.get("CODIGO", "").astype(str).str.strip()
-    out["DESCRIPCION DE LABOR"] = out.get("DESCRIPCION DE LABOR", out.get("Labor", ""))
-    out["CECO_FINAL"] = out.get("CECO_FINAL", "")
-    out["F. INGRESO"] = out.get("F. INGRESO", pd.NaT)
-    out["N° DNI"] = out.get("N° DNI", "").astype(str).str.strip()
-    out["APELLIDOS Y NOMBRES"] = out.get("APELLIDOS Y NOMBRES", "")
-    out["Horas_Dia"] = out.get("Horas_Dia", 0).astype(float) if "Horas_Dia" in out.columns else 0.0
-    out["Horas_Noche"] = out.get("Horas_Noche", 0).astype(float) if "Horas_Noche" in out.columns else 0.0
-    out["ID-ACT"] = out.get("ID-ACT", "").astype(str).str.strip()
-    out["ID-ACT-FINAL"] = out.get("ID-ACT", "").astype(str).str.strip()
-    out["C_LAB"] = out.get("C_LAB", "").astype(str).str.strip()
-    out["TXT DÍA"] = out.get("TXT DÍA", "")
-    out["TXT NOCHE"] = out.get("TXT NOCHE", "")
-
-    final_columns_order = [
-        "AREA", "GRUPO", "COD", "SEM", "FECHA", "CODIGO", "DESCRIPCION DE LABOR",
-        "CECO_FINAL", "F. INGRESO", "N° DNI", "APELLIDOS Y NOMBRES",
-        "Horas_Dia", "Horas_Noche", "ID-ACT-FINAL", "C_LAB", "TXT DÍA", "TXT NOCHE"
-    ]
-
-    for c in final_columns_order:
-        if c not in out.columns:
-            out[c] = ""
-
-    df_result_final = out[final_columns_order].copy()
-
-    # asegurar decimales en Horas
-    df_result_final["Horas_Dia"] = df_result_final["Horas_Dia"].fillna(0).astype(float).round(2)
-    df_result_final["Horas_Noche"] = df_result_final["Horas_Noche"].fillna(0).astype(float).round(2)
+    # ---------------- Segundo cuadro: resumen sin TURNO_FINAL - Horas_Dia/Horas_Noche ----------------
+    if df_third is not None:
+        st.subheader("📊 Resumen - Turno en columnas")
+        mostrar_tabla_paginada(df_third, key="tabla_columnas")
 
     # ---------------- Mostrar el Resultado Final (sincronizado con filtros) ----------------
     st.subheader("✅ Resumen final (según correo)")
-    st.dataframe(df_result_final, use_container_width=True, hide_index=True)
+    mostrar_tabla_paginada(df_result_final, key="tabla_final")
 
-    # ---------------- Cuarto cuadro: Validación por FECHA, AREA, APELLIDOS Y NOMBRES ----------------
+    # ---------------- Cuarto cuadro: Validación por FECHA, AREA, N° DNI, APELLIDOS Y NOMBRES ----------------
     df_summary_tot = None
-    if {"FECHA", "AREA", "APELLIDOS Y NOMBRES", "Horas", "TURNO_FINAL"}.issubset(df_filtered.columns):
-        # Usar pivot para evitar problemas con closures dentro de agg
-        df_pivot = df_filtered.pivot_table(
-            index=["FECHA", "AREA", "APELLIDOS Y NOMBRES"],
-            columns="TURNO_FINAL",
-            values="Horas",
-            aggfunc="sum",
-            fill_value=0
-        ).reset_index()
-
-        df_pivot.columns.name = None
-        df_pivot = df_pivot.rename(columns={"DIA": "Horas_Dia", "NOCHE": "Horas_Noche"})
-        if "Horas_Dia" not in df_pivot.columns:
-            df_pivot["Horas_Dia"] = 0
-        if "Horas_Noche" not in df_pivot.columns:
-            df_pivot["Horas_Noche"] = 0
-
-        df_pivot["Horas"] = (df_pivot["Horas_Dia"] + df_pivot["Horas_Noche"]).round(1)
-        df_pivot["Horas_Dia"] = df_pivot["Horas_Dia"].round(1)
-        df_pivot["Horas_Noche"] = df_pivot["Horas_Noche"].round(1)
-        df_pivot["HorasValidacion"] = (df_pivot["Horas_Dia"] + df_pivot["Horas_Noche"]).round(1)
-        df_pivot["Validación"] = df_pivot.apply(
-            lambda r: "CORRECTO" if r["Horas"] == r["HorasValidacion"] else "INCORRECTO",
-            axis=1
-        )
+    validacion_filter = []
+    if horas_validacion is not None:
+        df_pivot = resumen_validacion([horas_validacion], df_excepciones)
 
         # filtro adicional por Validación
         validacion_filter = st.sidebar.multiselect("Validación", sorted(df_pivot["Validación"].unique()))
@@ -709,52 +846,70 @@ if uploaded_file:
         total_row = pd.DataFrame({
             "FECHA": ["TOTAL"],
             "AREA": [""],
+            "N° DNI": [""],
             "APELLIDOS Y NOMBRES": [""],
             "Horas_Dia": [df_pivot["Horas_Dia"].sum().round(1)],
             "Horas_Noche": [df_pivot["Horas_Noche"].sum().round(1)],
             "Horas": [df_pivot["Horas"].sum().round(1)],
-            "HorasValidacion": [df_pivot["HorasValidacion"].sum().round(1)],
             "Validación": [""]
         })
         df_summary_tot = pd.concat([df_pivot, total_row], ignore_index=True)
 
 
-    st.subheader("📊 Validación por fecha, área y apellidos")
-    st.dataframe(df_summary_tot, use_container_width=True, hide_index=True)
+    st.subheader("📊 Validación por fecha, área, DNI y apellidos")
+    mostrar_tabla_paginada(df_summary_tot, key="tabla_validacion")
+
+    # ---------------- Excepciones de validación ----------------
+    st.subheader("⚠️ Excepciones de validación")
+    if df_excepciones.empty:
+        st.success("Las horas distribuidas cuadran con el tareo y los porcentajes suman 1.")
+    else:
+        mostrar_tabla_paginada(df_excepciones, key="tabla_excepciones")
 
     # ---------------- Descargar resultados ----------------
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        try:
-            df_tareo.to_excel(writer, index=False, sheet_name="Datos de Usuario GTH")
-        except Exception:
-            pass
-        try:
-            df_result_final.to_excel(writer, index=False, sheet_name="Resumen final (según correo)")
-        except Exception:
-            pass
-        if df_summary_tot is not None:
-            try:
-                df_summary_tot.to_excel(writer, index=False, sheet_name="Validacion")
-            except Exception:
-                pass
-        if df_third is not None:
-            try:
-                df_third.to_excel(writer, index=False, sheet_name="Resumen - Turno en columnas")
-            except Exception:
-                pass
-        try:
-            df_merged.to_excel(writer, index=False, sheet_name="%Kilos de Zupra")
-        except Exception:
-            pass
+    # El xlsx se arma una vez por conjunto de filtros, no en cada ejecución
+    if calculo["dir_trabajo"]:
+        # En memoria acotada el xlsx queda en un archivo del directorio de trabajo
+        exportar = partial(
+            exportar_excel_por_partes, calculo["dir_trabajo"], df_result_final, df_summary_tot, df_excepciones, df_third
+        )
+    else:
+        exportar = partial(exportar_excel, df_tareo, df_merged, df_result_final, df_summary_tot, df_excepciones, df_third)
+    datos_excel = en_cache_de_sesion(
+        "exportacion", (clave_calculo, clave_filtros, repr(validacion_filter)), exportar
+    )
+    if calculo["dir_trabajo"]:
+        # El archivo se lee solo cuando se pulsa el botón, no en cada ejecución
+        datos_excel = partial(leer_archivo, datos_excel)
 
     st.download_button(
         label="📥 Exportar la distribución",
-        data=output.getvalue(),
+        data=datos_excel,
         file_name="Sistemas de distribución de horas.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
 
+    # ---------------- Guardar resultados en PostgreSQL ----------------
+    # Clave idempotente: mismo archivo + mismos filtros = misma carga (se reemplaza, no se duplica)
+    id_carga = hashlib.sha256(
+        uploaded_file.getvalue() + repr(sorted(applied_filters.items())).encode("utf-8")
+    ).hexdigest()[:32]
+
+    if st.checkbox("Guardar también el resultado en Postgres"):
+        st.caption(f"Tabla: {TABLA_RESULTADOS} · clave de carga: {id_carga}")
+        if st.button("💾 Guardar resultado en Postgres"):
+            try:
+                conn = get_postgres_connection()
+                try:
+                    n_filas = escribir_resultados_postgres(df_result_final, id_carga, conn)
+                finally:
+                    conn.close()
+                st.success(f"{n_filas:,} filas guardadas en {TABLA_RESULTADOS}.")
+            except psycopg2.errors.UndefinedTable:
+                st.error(f"La tabla {TABLA_RESULTADOS} no existe; créala con `python prueba_carga.py --preparar-bd`.")
+            except psycopg2.Error as e:
+                st.error(f"No fue posible guardar en Postgres: {e}")
+
 else:
     st.info("Sube la estructura correcta en excel.")
 
@@ -0,0 +1,1080 @@
+"""Pipeline de distribución de horas Packing-Maquila (sin Streamlit).
+
+Merge del tareo con los porcentajes de Postgres, descomposición de horas por CECO,
+joins con DNI / LABORES y armado de las líneas TXT, validación de las horas
+distribuidas y escritura del resultado en Postgres. Vive en un módulo aparte para que pueda ejecutarse en procesos hijos
+(ver `procesar_por_shards`) y probarse sin levantar la app.
+"""
+import gc
+import multiprocessing
+import os
+import shutil
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import StringIO
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+def safe_str(x):
+    if pd.isna(x):
+        return ""
+    return str(x).strip()
+
+
+def formatear_id_actividad(x):
+    """ID_ACTIVIDAD como texto, sin decimales y con el 0 inicial."""
+    return "0" + str(x).split(".")[0] if pd.notna(x) else ""
+
+
+def sin_decimales(x):
+    return safe_str(str(x).split(".")[0]) if pd.notna(x) else ""
+
+
+def build_txt_row(row, turno="DIA"):
+    fecha = row.get("FECHA")
+    if pd.isna(fecha):
+        year = ""
+        month = ""
+        day = ""
+    else:
+        year = fecha.year
+        month = "{:02d}".format(fecha.month)
+        day = "{:02d}".format(fecha.day)
+    codigo_turno = "01" if turno == "DIA" else "03"
+    dni = safe_str(row.get("N° DNI"))
+    # usar ID-ACT ya normalizado como texto
+    id_act = safe_str(row.get("ID-ACT"))
+    c_lab = safe_str(row.get("C_LAB"))
+    ceco = safe_str(row.get("CECO_FINAL"))
+    horas = row.get("Horas_Dia", 0) if turno == "DIA" else row.get("Horas_Noche", 0)
+    minutos = int(round(float(horas or 0) * 60))
+    txt = f"0002|{year}{month}{day}|000004|{codigo_turno}|{dni}|{id_act}|{c_lab}|{ceco}|{minutos}|"
+    return txt
+
+
+def normalizar_tareo(df_tareo):
+    """Normaliza la hoja TAREO: N° DNI, FECHA, columnas mínimas, AREA/CECO y AREA2_tmp.
+    Sirve tanto para la hoja completa como para cada lote del modo de memoria acotada.
+    """
+    df_tareo.columns = [str(c).strip() for c in df_tareo.columns]
+
+    # Aseguramos columna DNI en tareo con nombre estándar "N° DNI"
+    if "N° DNI" in df_tareo.columns:
+        df_tareo["N° DNI"] = df_tareo["N° DNI"].astype(str).str.strip()
+    elif "N°DNI" in df_tareo.columns:
+        df_tareo["N° DNI"] = df_tareo["N°DNI"].astype(str).str.strip()
+    else:
+        possible = [c for c in df_tareo.columns if "DNI" in c.upper()]
+        if possible:
+            df_tareo["N° DNI"] = df_tareo[possible[0]].astype(str).str.strip()
+        else:
+            df_tareo["N° DNI"] = ""
+
+    # Campos FECHA
+    if "FECHA" in df_tareo.columns:
+        df_tareo["FECHA"] = pd.to_datetime(df_tareo["FECHA"], errors="coerce").dt.date
+    elif "F. INGRESO" in df_tareo.columns:
+        df_tareo["FECHA"] = pd.to_datetime(df_tareo["F. INGRESO"], errors="coerce").dt.date
+    else:
+        # intentar encontrar alguna columna fecha
+        possible_fecha = [c for c in df_tareo.columns if "FECHA" in c.upper()]
+        if possible_fecha:
+            df_tareo["FECHA"] = pd.to_datetime(df_tareo[possible_fecha[0]], errors="coerce").dt.date
+        else:
+            df_tareo["FECHA"] = pd.NaT
+
+    # Aseguramos columnas que usaremos y convertimos a string cuando corresponda
+    def ensure_cols_exist(df, cols):
+        for col in cols:
+            if col not in df.columns:
+                df[col] = ""
+
+    ensure_cols_exist(df_tareo, ["AREA","GRUPO","COD","SEM","CODIGO","DESCRIPCION DE LABOR","CECO","HE_D","H_NOCTURNAS","APELLIDOS Y NOMBRES"])
+
+    # Convertir a string columnas relevantes
+    for c in ["AREA","CECO","CODIGO"]:
+        if c in df_tareo.columns:
+            df_tareo[c] = df_tareo[c].astype(str).str.strip()
+
+    # ---------------- Preparar TAREO para merges ----------------
+    # CECO/AREA
+    if "AREA" in df_tareo.columns:
+        df_tareo["AREA"] = df_tareo["AREA"].astype(str).str.strip()
+    else:
+        df_tareo["AREA"] = ""
+
+    if "CECO" in df_tareo.columns:
+        df_tareo["CECO"] = df_tareo["CECO"].astype(str).str.strip()
+    else:
+        df_tareo["CECO"] = "Sin CECO"
+
+    # Crear AREA2_tmp igual que script original (mapear AREA)
+    def map_area(area):
+        a = str(area).strip().upper()
+        if a in ["OBRAS EN CURSO", "GESTION DEL TALENTO HUMANO", "SSOMA"]:
+            return "NO"
+        elif a in ["PRODUCCION", "ALMACEN DE PISO PRODUCCION"]:
+            return "PRODUCCION"
+        else:
+            return "RECEPCION"
+
+    df_tareo["AREA2_tmp"] = df_tareo["AREA"].apply(map_area)
+
+    return df_tareo
+
+
+class MaestrosCompartidos:
+    """Tablas maestras DNI y LABORES compartidas por todas las sesiones del proceso.
+
+    Cada hoja subida se aplica como delta: se insertan las claves nuevas y se reemplazan
+    las que cambiaron (por hash de fila). `version` solo sube cuando algo cambia. Las
+    tablas nunca se modifican en sitio, se reemplazan, así que los lectores pueden usar
+    la foto que recibieron sin bloquear.
+
+    Las tablas quedan indexadas por DNI / CODIGO para los joins por búsqueda, y en
+    LABORES los textos finales (ID_ACTIVIDAD, COD_LABOR, ID-ACT, C_LAB) se calculan
+    una sola vez por clave al aplicar el delta.
+    """
+
+    COLUMNAS = {
+        "dni": ("DNI", ["FECHA_INGRESO", "APELLIDOS"]),
+        "labores": ("CODIGO", ["Labor", "ID_ACTIVIDAD", "COD_LABOR"]),
+    }
+    DERIVADAS = {"dni": [], "labores": ["ID-ACT", "C_LAB"]}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._tablas = {}
+        self._hashes = {}
+        for nombre, (clave, columnas) in self.COLUMNAS.items():
+            self._tablas[nombre] = pd.DataFrame(columns=[clave] + columnas + self.DERIVADAS[nombre]).set_index(clave)
+            self._hashes[nombre] = pd.Series(dtype="uint64")
+
+    def _aplicar_delta(self, nombre, df):
+        clave, columnas = self.COLUMNAS[nombre]
+        if df.empty or clave not in df.columns:
+            return 0
+        delta = df.reindex(columns=[clave] + columnas).copy()
+        delta[clave] = delta[clave].astype(str).str.strip()
+        # Igual que antes de cada merge: la primera fila por clave dentro de la hoja
+        delta = delta.drop_duplicates(subset=[clave]).set_index(clave)
+
+        hashes = pd.util.hash_pandas_object(delta, index=True)
+        previos = self._hashes[nombre]
+        es_nueva = ~hashes.index.isin(previos.index)
+        comunes = hashes.index[~es_nueva]
+        distinta = previos.loc[comunes].to_numpy() != hashes.loc[comunes].to_numpy()
+        cambiados = hashes.index[es_nueva].append(comunes[distinta])
+        if len(cambiados) == 0:
+            return 0
+
+        nuevas = delta.loc[cambiados]
+        if nombre == "labores":
+            nuevas["ID_ACTIVIDAD"] = nuevas["ID_ACTIVIDAD"].map(formatear_id_actividad)
+            nuevas["COD_LABOR"] = nuevas["COD_LABOR"].map(safe_str)
+            nuevas["ID-ACT"] = nuevas["ID_ACTIVIDAD"].map(sin_decimales)
+            nuevas["C_LAB"] = nuevas["COD_LABOR"].map(sin_decimales)
+
+        actual = self._tablas[nombre]
+        if actual.empty:
+            self._tablas[nombre] = nuevas
+            self._hashes[nombre] = hashes[cambiados]
+        else:
+            self._tablas[nombre] = pd.concat([actual.drop(index=cambiados, errors="ignore"), nuevas])
+            self._hashes[nombre] = pd.concat([previos.drop(index=cambiados, errors="ignore"), hashes[cambiados]])
+        return len(cambiados)
+
+    def aplicar(self, df_dni, df_labores):
+        """Aplica las hojas subidas como delta y devuelve (version, df_dni, df_labores),
+        indexados por DNI / CODIGO (una fila por clave), listos para los joins.
+        """
+        with self._lock:
+            cambios = self._aplicar_delta("dni", df_dni) + self._aplicar_delta("labores", df_labores)
+            if cambios:
+                self.version += 1
+            return self.version, self._tablas["dni"], self._tablas["labores"]
+
+
+def _columna_dni(df):
+    return df.get("N° DNI", df.get("N°DNI", "")).astype(str).str.strip()
+
+
+def decidir_distribucion(df_tareo, df_dni):
+    """Decisiones de `procesar_distribucion` que dependen del tareo completo y no de
+    cada fila. Se toman una vez antes de dividir el tareo (shards, delta, lotes) para
+    que cada parte dé lo mismo que la ejecución secuencial:
+
+    - `fecha_de`: columna de la que sale FECHA ("FECHA", otra columna con FECHA en el
+      nombre si FECHA falta o viene toda vacía, o None si no hay ninguna).
+    - `nombres_desde_apellidos`: si APELLIDOS Y NOMBRES se toma de APELLIDOS (algún DNI
+      del tareo tiene apellidos en el maestro, o el maestro viene vacío).
+    """
+    fecha_de = "FECHA"
+    if "FECHA" not in df_tareo.columns or df_tareo["FECHA"].isnull().all():
+        possible_fecha = [c for c in df_tareo.columns if "FECHA" in c.upper()]
+        fecha_de = possible_fecha[0] if possible_fecha else None
+
+    if df_tareo.empty:
+        nombres_desde_apellidos = False
+    elif not df_dni.empty:
+        nombres_desde_apellidos = bool(_columna_dni(df_tareo).map(df_dni["APELLIDOS"]).notna().any())
+    elif "APELLIDOS" in df_tareo.columns:
+        nombres_desde_apellidos = bool(df_tareo["APELLIDOS"].notna().any())
+    else:
+        nombres_desde_apellidos = True  # APELLIDOS se rellena con ""
+    return {"fecha_de": fecha_de, "nombres_desde_apellidos": nombres_desde_apellidos}
+
+
+def combinar_decisiones(a, b):
+    """Decisiones del tareo formado por dos partes con decisiones `a` y `b` (`a` puede ser None)."""
+    if a is None:
+        return b
+    return {
+        "fecha_de": "FECHA" if "FECHA" in (a["fecha_de"], b["fecha_de"]) else a["fecha_de"],
+        "nombres_desde_apellidos": a["nombres_desde_apellidos"] or b["nombres_desde_apellidos"],
+    }
+
+
+def procesar_distribucion(df_tareo, df_postgres_lookup, df_dni, df_labores, decisiones=None):
+    """Aplica merge, distribución, joins y TXT a un tareo ya normalizado.
+    `df_postgres_lookup` debe traer `fecha` (date) y `area` (mayúsculas).
+    `df_dni` / `df_labores` deben venir indexados por DNI / CODIGO (ver `MaestrosCompartidos`).
+    Si `df_tareo` es solo una parte del tareo, `decisiones` debe venir de
+    `decidir_distribucion` sobre el tareo completo.
+    Devuelve (df_merged, df_final).
+    """
+    if decisiones is None:
+        decisiones = decidir_distribucion(df_tareo, df_dni)
+
+    # ---------------- Merge TAREO con POSTGRES ----------------
+    df_tareo_for_merge = df_tareo.copy()
+    # posición original de cada fila del tareo (orden determinista al unir shards)
+    if "_fila_tareo" not in df_tareo_for_merge.columns:
+        df_tareo_for_merge["_fila_tareo"] = range(len(df_tareo_for_merge))
+    # aseguramos FECHA en df_tareo_for_merge
+    if decisiones["fecha_de"] is None:
+        df_tareo_for_merge["FECHA"] = pd.NaT
+    elif decisiones["fecha_de"] != "FECHA":
+        df_tareo_for_merge["FECHA"] = pd.to_datetime(df_tareo_for_merge[decisiones["fecha_de"]], errors="coerce").dt.date
+
+    df_tareo_for_merge["AREA2_tmp_UP"] = df_tareo_for_merge["AREA2_tmp"].astype(str).str.strip().str.upper()
+    df_tareo_for_merge["FECHA"] = pd.to_datetime(df_tareo_for_merge["FECHA"], errors="coerce").dt.date
+
+    # Intentar merge con la columna normalizada
+    left_on_cols = ["FECHA", "AREA2_tmp_UP"] if "AREA2_tmp_UP" in df_tareo_for_merge.columns else ["FECHA", "AREA2_tmp"]
+
+    df_merged = pd.merge(
+        df_tareo_for_merge,
+        df_postgres_lookup,
+        left_on=left_on_cols,
+        right_on=["fecha", "area"],
+        how="left",
+        suffixes=("_tareo", "_pg")
+    )
+
+    # ---------------- Aplicar la lógica de descomposición y distribución de horas ----------------
+    registros_finales = []
+
+    # Iteramos cada fila del merge y aplicamos reglas de negocio
+    for _, row in df_merged.iterrows():
+        he_d = row.get("HE_D", 0) or 0
+        h_noche = row.get("H_NOCTURNAS", 0) or 0
+        try:
+            packing = float(row.get("packing", 0) or 0)
+        except:
+            packing = 0.0
+        try:
+            maquila = float(row.get("SERVICIO MAQUILA", 0) or 0)
+        except:
+            maquila = 0.0
+
+        area_val = str(row.get("AREA", "")).strip()
+        ceco_val = str(row.get("CECO", "Sin CECO")).strip()
+
+        # CASOS según la lógica original
+        if area_val in ["OBRAS EN CURSO", "GESTION DEL TALENTO HUMANO", "SSOMA"]:
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": ceco_val,
+                "Horas_Dia": round(float(he_d), 2),
+                "Horas_Noche": round(float(h_noche), 2)
+            })
+        elif area_val in ["PRODUCCION", "ALMACEN DE PISO PRODUCCION"]:
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": "PROCESO_PACK",
+                "Horas_Dia": round(float(he_d * packing), 2),
+                "Horas_Noche": round(float(h_noche * packing), 2)
+            })
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": "SERV_MAQUILA",
+                "Horas_Dia": round(float(he_d * maquila), 2),
+                "Horas_Noche": round(float(h_noche * maquila), 2)
+            })
+        elif ceco_val == "RECEP_PACK":
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": "RECEP_PACK",
+                "Horas_Dia": round(float(he_d * packing), 2),
+                "Horas_Noche": round(float(h_noche * packing), 2)
+            })
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": "SERV_MAQUILA",
+                "Horas_Dia": round(float(he_d * maquila), 2),
+                "Horas_Noche": round(float(h_noche * maquila), 2)
+            })
+        else:
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": ceco_val,
+                "Horas_Dia": round(float(he_d * packing), 2),
+                "Horas_Noche": round(float(h_noche * packing), 2)
+            })
+            registros_finales.append({
+                **row,
+                "CECO_FINAL": "SERV_MAQUILA",
+                "Horas_Dia": round(float(he_d * maquila), 2),
+                "Horas_Noche": round(float(h_noche * maquila), 2)
+            })
+
+    df_final = pd.DataFrame(registros_finales)
+
+    # Asegurar Horas_Dia/Noche
+    if not df_final.empty:
+        df_final["Horas_Dia"] = df_final.get("Horas_Dia", 0).fillna(0).astype(float)
+        df_final["Horas_Noche"] = df_final.get("Horas_Noche", 0).fillna(0).astype(float)
+    else:
+        df_final["Horas_Dia"] = pd.Series(dtype=float)
+        df_final["Horas_Noche"] = pd.Series(dtype=float)
+
+    # ---------------- Join con hoja DNI para traer FECHA_INGRESO y APELLIDOS ----------------
+    df_final["N° DNI"] = _columna_dni(df_final)
+
+    if not df_dni.empty:
+        # Búsqueda clave -> valor contra el índice del maestro: solo se agregan las columnas necesarias
+        for col in ["FECHA_INGRESO", "APELLIDOS"]:
+            df_final[col] = df_final["N° DNI"].map(df_dni[col])
+    else:
+        # Asegurar columnas si el merge no se hizo
+        if "FECHA_INGRESO" not in df_final.columns:
+            df_final["FECHA_INGRESO"] = pd.NaT
+        if "APELLIDOS" not in df_final.columns:
+            df_final["APELLIDOS"] = ""
+
+    # ---------------- Join con hoja LABORES (por CODIGO) ----------------
+    if "CODIGO" in df_final.columns:
+        df_final["CODIGO"] = df_final["CODIGO"].astype(str).str.strip()
+    else:
+        if "COD" in df_final.columns:
+            df_final["CODIGO"] = df_final["COD"].astype(str).str.strip()
+        else:
+            df_final["CODIGO"] = ""
+
+    textos_labor = ["ID_ACTIVIDAD", "COD_LABOR", "ID-ACT", "C_LAB"]
+    if not df_labores.empty:
+        # Los textos finales ya vienen formateados por clave en el maestro
+        for col in ["Labor"] + textos_labor:
+            df_final[col] = df_final["CODIGO"].map(df_labores[col])
+        df_final[textos_labor] = df_final[textos_labor].fillna("")
+    else:
+        if "Labor" not in df_final.columns:
+            df_final["Labor"] = ""
+        if "ID_ACTIVIDAD" not in df_final.columns:
+            df_final["ID_ACTIVIDAD"] = ""
+        if "COD_LABOR" not in df_final.columns:
+            df_final["COD_LABOR"] = ""
+        # Asegurarnos de que ID_ACTIVIDAD y COD_LABOR sean texto y sin decimales
+        df_final["ID_ACTIVIDAD"] = df_final["ID_ACTIVIDAD"].map(formatear_id_actividad)
+        df_final["COD_LABOR"] = df_final["COD_LABOR"].map(safe_str)
+        df_final["ID-ACT"] = df_final["ID_ACTIVIDAD"].map(sin_decimales)
+        df_final["C_LAB"] = df_final["COD_LABOR"].map(sin_decimales)
+
+    # Normalizar FECHA_INGRESO -> "F. INGRESO"
+    if "FECHA_INGRESO" in df_final.columns:
+        df_final["F. INGRESO"] = df_final["FECHA_INGRESO"]
+    elif "F. INGRESO" in df_final.columns:
+        df_final["F. INGRESO"] = pd.to_datetime(df_final["F. INGRESO"], errors="coerce").dt.date
+    else:
+        df_final["F. INGRESO"] = pd.NaT
+
+    # APELLIDOS Y NOMBRES
+    if "APELLIDOS" in df_final.columns and decisiones["nombres_desde_apellidos"]:
+        df_final["APELLIDOS Y NOMBRES"] = df_final["APELLIDOS"]
+    else:
+        if "APELLIDOS Y NOMBRES" in df_final.columns:
+            df_final["APELLIDOS Y NOMBRES"] = df_final["APELLIDOS Y NOMBRES"]
+        else:
+            df_final["APELLIDOS Y NOMBRES"] = ""
+
+    # ---------------- Asegurar que exista DESCRIPCION DE LABOR para mostrarse en los cuadros ----------------
+    # Llenamos "DESCRIPCION DE LABOR" desde la columna Labor si existe
+    df_final["DESCRIPCION DE LABOR"] = df_final.get("Labor", df_final.get("DESCRIPCION DE LABOR", ""))
+
+    # ---------------- Generar TXT DÍA / TXT NOCHE ----------------
+    df_final["FECHA"] = pd.to_datetime(df_final.get("FECHA"), errors="coerce").dt.date
+
+    df_final["TXT DÍA"] = df_final.apply(lambda r: build_txt_row(r, "DIA"), axis=1)
+    df_final["TXT NOCHE"] = df_final.apply(lambda r: build_txt_row(r, "NOCHE"), axis=1)
+
+    return df_merged, df_final
+
+
+def concatenar_partes(partes):
+    """Concatena partes de un resultado. Una parte sin coincidencias deja columnas
+    todo-NaN como float; las columnas cuyo tipo difiere entre partes se vuelven a
+    inferir sobre el total, como en la ejecución secuencial.
+    """
+    df = pd.concat(partes, ignore_index=True)
+    distintas = [
+        c for c in df.columns
+        if len({str(p[c].dtype) for p in partes if c in p.columns and len(p)}) > 1
+    ]
+    if distintas:
+        df[distintas] = df[distintas].infer_objects()
+    return df
+
+
+# Maestros de cada proceso del pool: llegan una vez por proceso (initializer), no en cada tarea
+_MAESTROS_DEL_PROCESO = {}
+
+
+def _iniciar_proceso(df_dni, df_labores):
+    _MAESTROS_DEL_PROCESO["dni"] = df_dni
+    _MAESTROS_DEL_PROCESO["labores"] = df_labores
+
+
+def _procesar_shard(args):
+    shard, pg_shard, decisiones = args
+    return procesar_distribucion(
+        shard, pg_shard, _MAESTROS_DEL_PROCESO["dni"], _MAESTROS_DEL_PROCESO["labores"], decisiones
+    )
+
+
+def crear_pool(df_dni, df_labores, max_workers=None):
+    """Pool de procesos con `spawn` (sin heredar hilos ni conexiones del servidor) que
+    recibe los maestros una sola vez por proceso."""
+    return ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_iniciar_proceso,
+        initargs=(df_dni, df_labores),
+    )
+
+
+class PoolCompartido:
+    """Un único pool de procesos compartido por todas las sesiones del servidor.
+
+    El pool se crea para unos maestros (por identidad: `MaestrosCompartidos` reemplaza
+    las tablas cuando cambian) y un número de procesos. Si una sesión pide otros, se
+    crea un pool nuevo y el anterior se cierra en cuanto ninguna sesión lo está usando.
+    Con `spawn` cada proceso nuevo vuelve a importar el script principal (bajo Streamlit,
+    la app sin archivo subido, que no hace nada): por eso el pool se reutiliza.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actual = None
+
+    @contextmanager
+    def usar(self, df_dni, df_labores, max_workers=None):
+        max_workers = max_workers or os.cpu_count()
+        with self._lock:
+            entrada = self._actual
+            if entrada is None or not (
+                entrada["dni"] is df_dni and entrada["labores"] is df_labores and entrada["max_workers"] == max_workers
+            ):
+                if entrada is not None and entrada["en_uso"] == 0:
+                    entrada["pool"].shutdown(wait=False)
+                entrada = self._actual = {
+                    "pool": crear_pool(df_dni, df_labores, max_workers), "dni": df_dni, "labores": df_labores,
+                    "max_workers": max_workers, "en_uso": 0,
+                }
+            entrada["en_uso"] += 1
+        try:
+            yield entrada["pool"]
+        finally:
+            with self._lock:
+                entrada["en_uso"] -= 1
+                if entrada is not self._actual and entrada["en_uso"] == 0:
+                    entrada["pool"].shutdown(wait=False)
+
+    def cerrar(self):
+        with self._lock:
+            if self._actual is not None:
+                self._actual["pool"].shutdown(wait=False)
+                self._actual = None
+
+
+def procesar_por_shards(df_tareo, df_postgres_lookup, df_dni, df_labores, por="FECHA", pool=None, max_workers=None,
+                        decisiones=None):
+    """Divide el tareo por `por` (FECHA o SEM), procesa cada shard en un pool de procesos
+    y concatena en el mismo orden que la ejecución secuencial (por `_fila_tareo`).
+    Las decisiones globales se toman sobre el tareo completo antes de dividirlo.
+    `pool` es un `PoolCompartido`; sin él se crea un pool solo para esta llamada.
+    """
+    df_tareo = df_tareo.copy()
+    if "_fila_tareo" not in df_tareo.columns:
+        df_tareo["_fila_tareo"] = range(len(df_tareo))
+    if decisiones is None:
+        decisiones = decidir_distribucion(df_tareo, df_dni)
+    if df_tareo.empty:
+        return procesar_distribucion(df_tareo, df_postgres_lookup, df_dni, df_labores, decisiones)
+
+    tareas = []
+    for _, shard in df_tareo.groupby(por, sort=True, dropna=False):
+        # a cada proceso solo se le envían los porcentajes de sus fechas
+        fechas = set(pd.to_datetime(shard["FECHA"], errors="coerce").dt.date.dropna())
+        pg_shard = df_postgres_lookup[df_postgres_lookup["fecha"].isin(fechas)]
+        tareas.append((shard, pg_shard, decisiones))
+
+    if pool is None:
+        with crear_pool(df_dni, df_labores, max_workers) as executor:
+            resultados = list(executor.map(_procesar_shard, tareas))
+    else:
+        with pool.usar(df_dni, df_labores, max_workers) as executor:
+            resultados = list(executor.map(_procesar_shard, tareas))
+
+    df_merged = concatenar_partes([m for m, _ in resultados])
+    df_final = concatenar_partes([f for _, f in resultados])
+    df_merged = df_merged.sort_values("_fila_tareo", kind="stable").reset_index(drop=True)
+    df_final = df_final.sort_values("_fila_tareo", kind="stable").reset_index(drop=True)
+    return df_merged, df_final
+
+
+def firmar_tareo(df_tareo):
+    """Clave lógica (N° DNI, FECHA, CODIGO y n° de ocurrencia) y hash de contenido por fila."""
+    logica = pd.util.hash_pandas_object(df_tareo[["N° DNI", "FECHA", "CODIGO"]].astype(str), index=False)
+    ocurrencia = logica.groupby(logica).cumcount()
+    clave = pd.util.hash_pandas_object(pd.DataFrame({"k": logica, "n": ocurrencia}), index=False)
+    contenido = pd.util.hash_pandas_object(df_tareo.drop(columns=["_fila_tareo"], errors="ignore").astype(str), index=False)
+    return clave.to_numpy(), contenido.to_numpy()
+
+
+def procesar_delta(df_tareo, df_postgres_lookup, df_dni, df_labores, firma, previo=None, procesar=procesar_distribucion):
+    """Recalcula solo las filas del tareo agregadas o modificadas respecto de `previo`
+    (estado devuelto por la corrida anterior) y reutiliza el resultado de las demás.
+    Si cambió `firma` (porcentajes de Postgres o versión de maestros) o alguna decisión
+    global de `decidir_distribucion` se recalcula todo. `procesar` recibe las decisiones
+    del tareo completo, así las filas recalculadas quedan igual que en una corrida completa.
+    Devuelve (df_merged, df_final, estado, resumen).
+    """
+    df_tareo = df_tareo.copy()
+    df_tareo["_fila_tareo"] = range(len(df_tareo))
+    claves, contenidos = firmar_tareo(df_tareo)
+    decisiones = decidir_distribucion(df_tareo, df_dni)
+
+    if previo is None or previo["firma"] != firma or previo["decisiones"] != decisiones:
+        previo = {
+            "claves": pd.Series([], dtype="uint64"), "contenidos": pd.Series([], dtype="uint64"),
+            "df_merged": None, "df_final": None,
+        }
+
+    # Posición previa y hash previo de cada clave lógica
+    pos_previa = pd.Series(range(len(previo["claves"])), index=previo["claves"])
+    existe = pd.Index(previo["claves"]).isin(claves)
+    eliminadas = int((~existe).sum())
+    pos = pos_previa.reindex(claves).to_numpy()  # NaN si la clave es nueva
+    nueva = pd.isna(pos)
+    igual = ~nueva
+    igual[igual] = previo["contenidos"].to_numpy()[pos[igual].astype(int)] == contenidos[igual]
+    modificada = ~nueva & ~igual
+
+    partes_merged, partes_final = [], []
+    if igual.any():
+        # Reutilizar resultados previos, renumerando _fila_tareo a la posición actual
+        nueva_pos = pd.Series(df_tareo["_fila_tareo"].to_numpy()[igual], index=pos[igual].astype(int))
+        for df_prev, partes in [(previo["df_merged"], partes_merged), (previo["df_final"], partes_final)]:
+            reuso = df_prev[df_prev["_fila_tareo"].isin(nueva_pos.index)].copy()
+            reuso["_fila_tareo"] = reuso["_fila_tareo"].map(nueva_pos)
+            partes.append(reuso)
+    if (~igual).any() or not partes_final:
+        df_merged_n, df_final_n = procesar(df_tareo[~igual], df_postgres_lookup, df_dni, df_labores, decisiones=decisiones)
+        partes_merged.append(df_merged_n)
+        partes_final.append(df_final_n)
+
+    df_merged = concatenar_partes(partes_merged)
+    df_final = concatenar_partes(partes_final)
+    df_merged = df_merged.sort_values("_fila_tareo", kind="stable").reset_index(drop=True)
+    df_final = df_final.sort_values("_fila_tareo", kind="stable").reset_index(drop=True)
+
+    estado = {
+        "firma": firma, "decisiones": decisiones,
+        "claves": pd.Series(claves), "contenidos": pd.Series(contenidos),
+        "df_merged": df_merged, "df_final": df_final,
+    }
+    resumen = {
+        "agregadas": int(nueva.sum()),
+        "modificadas": int(modificada.sum()),
+        "eliminadas": eliminadas,
+        "reutilizadas": int(igual.sum()),
+    }
+    return df_merged, df_final, estado, resumen
+
+
+# ---------------- Validación ----------------
+COLUMNAS_EXCEPCIONES = ["TIPO", "FECHA", "N° DNI", "APELLIDOS Y NOMBRES", "AREA", "ESPERADO", "DISTRIBUIDO", "DIFERENCIA"]
+CLAVE_HORAS = ["N° DNI", "FECHA", "AREA"]
+# Clave del cuadro de validación (las horas por turno de la app vienen con esta clave)
+CLAVE_RESUMEN = ["FECHA", "AREA", "N° DNI", "APELLIDOS Y NOMBRES"]
+
+
+def agregados_validacion(df_tareo, df_merged, df_final):
+    """Partes sumables de la validación de un tareo (o de un lote): porcentajes por fecha
+    y área, y horas del tareo y distribuidas por trabajador, día y área. Los de varios
+    lotes se juntan con `combinar_agregados`.
+    """
+    agregados = {"pct": None, "origen": None, "distribuido": None}
+
+    # Porcentajes packing + maquila por fecha y área (solo áreas que se distribuyen)
+    if not df_merged.empty:
+        area_merged = df_merged["AREA"].astype(str).str.strip()
+        se_distribuye = ~area_merged.isin(["OBRAS EN CURSO", "GESTION DEL TALENTO HUMANO", "SSOMA"])
+        agregados["pct"] = pd.DataFrame({
+            "FECHA": df_merged["FECHA"],
+            "AREA": df_merged.get("AREA2_tmp", area_merged),
+            "DISTRIBUIDO": pd.to_numeric(df_merged.get("packing", 0), errors="coerce")
+            + pd.to_numeric(df_merged.get("SERVICIO MAQUILA", 0), errors="coerce"),
+        })[se_distribuye].drop_duplicates(subset=["FECHA", "AREA"])
+
+    # Horas por trabajador, día y área: tareo original vs. horas distribuidas
+    if not df_tareo.empty:
+        agregados["origen"] = pd.DataFrame({
+            "N° DNI": df_tareo["N° DNI"].astype(str).str.strip(),
+            "FECHA": df_tareo["FECHA"],
+            "AREA": df_tareo["AREA"].astype(str).str.strip(),
+            "DIA": pd.to_numeric(df_tareo["HE_D"], errors="coerce").fillna(0),
+            "NOCHE": pd.to_numeric(df_tareo["H_NOCTURNAS"], errors="coerce").fillna(0),
+        }).groupby(CLAVE_HORAS, dropna=False).agg(DIA=("DIA", "sum"), NOCHE=("NOCHE", "sum"))
+
+        if df_final.empty:
+            agregados["distribuido"] = pd.DataFrame(columns=["APELLIDOS Y NOMBRES", "DIA", "NOCHE", "FILAS"])
+        else:
+            agregados["distribuido"] = pd.DataFrame({
+                "N° DNI": df_final["N° DNI"].astype(str).str.strip(),
+                "FECHA": df_final["FECHA"],
+                "AREA": df_final["AREA"].astype(str).str.strip(),
+                "APELLIDOS Y NOMBRES": df_final["APELLIDOS Y NOMBRES"],
+                "DIA": df_final["Horas_Dia"],
+                "NOCHE": df_final["Horas_Noche"],
+            }).groupby(CLAVE_HORAS, dropna=False).agg(
+                **{"APELLIDOS Y NOMBRES": ("APELLIDOS Y NOMBRES", "first")},
+                DIA=("DIA", "sum"), NOCHE=("NOCHE", "sum"), FILAS=("DIA", "size")
+            )
+    return agregados
+
+
+def combinar_agregados(a, b):
+    """Junta los agregados de dos lotes consecutivos (`a` puede ser None)."""
+    if a is None:
+        return b
+
+    def juntar(x, y, reducir):
+        if x is None or y is None:
+            return y if x is None else x
+        return reducir(pd.concat([x, y]))
+
+    def por_clave(df):
+        return df.groupby(level=list(range(len(CLAVE_HORAS))), dropna=False)
+
+    return {
+        "pct": juntar(a["pct"], b["pct"], lambda df: df.drop_duplicates(subset=["FECHA", "AREA"])),
+        "origen": juntar(a["origen"], b["origen"], lambda df: por_clave(df).sum()),
+        "distribuido": juntar(
+            a["distribuido"], b["distribuido"],
+            lambda df: por_clave(df).agg({"APELLIDOS Y NOMBRES": "first", "DIA": "sum", "NOCHE": "sum", "FILAS": "sum"})
+        ),
+    }
+
+
+def excepciones_de(agregados, tolerancia_pct=0.001):
+    """Lista de excepciones a partir de los agregados de todo el tareo."""
+    hallazgos = []
+
+    if agregados["pct"] is not None:
+        pct = agregados["pct"].copy()
+        pct["DISTRIBUIDO"] = pct["DISTRIBUIDO"].fillna(0).round(4)
+        pct["ESPERADO"] = 1.0
+        pct["DIFERENCIA"] = (pct["DISTRIBUIDO"] - pct["ESPERADO"]).round(4)
+        pct = pct[pct["DIFERENCIA"].abs() > tolerancia_pct]
+        pct["TIPO"] = "PORCENTAJE PACKING+MAQUILA"
+        hallazgos.append(pct)
+
+    if agregados["origen"] is not None:
+        comp = agregados["origen"].join(agregados["distribuido"], how="outer", lsuffix="_ORIG", rsuffix="_DIST")
+        comp[["DIA_ORIG", "NOCHE_ORIG", "DIA_DIST", "NOCHE_DIST", "FILAS"]] = (
+            comp[["DIA_ORIG", "NOCHE_ORIG", "DIA_DIST", "NOCHE_DIST", "FILAS"]].fillna(0)
+        )
+        comp = comp.reset_index()
+        # Cada fila distribuida se redondea a 2 decimales: tolerar ese error acumulado
+        tolerancia = comp["FILAS"] * 0.005 + 1e-6
+
+        for turno, tipo in [("DIA", "HORAS DÍA"), ("NOCHE", "HORAS NOCHE")]:
+            diferencia = comp[f"{turno}_DIST"] - comp[f"{turno}_ORIG"]
+            fallas = comp[diferencia.abs() > tolerancia]
+            hallazgos.append(pd.DataFrame({
+                "TIPO": tipo,
+                "FECHA": fallas["FECHA"],
+                "N° DNI": fallas["N° DNI"],
+                "APELLIDOS Y NOMBRES": fallas["APELLIDOS Y NOMBRES"],
+                "AREA": fallas["AREA"],
+                "ESPERADO": fallas[f"{turno}_ORIG"].round(2),
+                "DISTRIBUIDO": fallas[f"{turno}_DIST"].round(2),
+                "DIFERENCIA": diferencia[fallas.index].round(2),
+            }))
+
+    hallazgos = [h for h in hallazgos if not h.empty]
+    if not hallazgos:
+        return pd.DataFrame(columns=COLUMNAS_EXCEPCIONES)
+    return pd.concat(hallazgos, ignore_index=True).reindex(columns=COLUMNAS_EXCEPCIONES)
+
+
+def validar_distribucion(df_tareo, df_merged, df_final, tolerancia_pct=0.001):
+    """Contrasta las horas distribuidas (Horas_Dia/Horas_Noche) por trabajador y día
+    contra HE_D/H_NOCTURNAS del tareo, y revisa que packing + maquila sumen 1.
+    Devuelve solo las filas con hallazgos (lista de excepciones).
+    """
+    return excepciones_de(agregados_validacion(df_tareo, df_merged, df_final), tolerancia_pct)
+
+
+def sumar_horas_validacion(a, b):
+    """Suma dos Series de horas por trabajador y turno (clave CLAVE_RESUMEN + TURNO_FINAL) (`a` puede ser None)."""
+    if a is None or b is None:
+        return b if a is None else a
+    return pd.concat([a, b]).groupby(level=list(range(len(CLAVE_RESUMEN) + 1)), dropna=False).sum()
+
+
+def resumen_validacion(horas_validacion, df_excepciones):
+    """Cuadro de validación por FECHA, AREA, N° DNI y APELLIDOS Y NOMBRES a partir de las
+    horas por turno de `construir_vistas` de la app (una o varias Series, que se suman).
+    """
+    # N° DNI en la clave: dos trabajadores con el mismo nombre no se mezclan, y los DNI
+    # sin nombre en el maestro (NaN) no se descartan (dropna=False)
+    df_pivot = (
+        pd.concat(horas_validacion).groupby(level=list(range(len(CLAVE_RESUMEN) + 1)), dropna=False).sum()
+        .unstack("TURNO_FINAL", fill_value=0)
+        .reindex(columns=["DIA", "NOCHE"], fill_value=0)
+        .rename(columns={"DIA": "Horas_Dia", "NOCHE": "Horas_Noche"})
+        .reset_index()
+    )
+    df_pivot.columns.name = None
+
+    df_pivot["Horas"] = (df_pivot["Horas_Dia"] + df_pivot["Horas_Noche"]).round(1)
+    df_pivot["Horas_Dia"] = df_pivot["Horas_Dia"].round(1)
+    df_pivot["Horas_Noche"] = df_pivot["Horas_Noche"].round(1)
+
+    # INCORRECTO cuando el trabajador (por DNI) tiene excepciones de horas ese día en esa área
+    excepciones_horas = df_excepciones[df_excepciones["TIPO"].isin(["HORAS DÍA", "HORAS NOCHE"])]
+    clave_validacion = ["N° DNI", "FECHA", "AREA"]
+    con_error = pd.MultiIndex.from_frame(df_pivot[clave_validacion]).isin(
+        pd.MultiIndex.from_frame(excepciones_horas[clave_validacion])
+    )
+    df_pivot["Validación"] = np.where(con_error, "INCORRECTO", "CORRECTO")
+    return df_pivot
+
+
+# ---------------- Modo de memoria acotada ----------------
+# Tipos que parquet guarda tal cual en columnas object; el resto se guarda como texto
+TIPOS_PARQUET = {"string", "date", "datetime", "empty", "integer", "floating", "mixed-integer-float", "boolean"}
+
+
+def nombres_de_hojas(archivo):
+    """Nombres de hojas del libro sin leer su contenido."""
+    if hasattr(archivo, "seek"):
+        archivo.seek(0)
+    wb = openpyxl.load_workbook(archivo, read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def leer_hoja_por_bloques(archivo, nombre_hoja, filas_por_bloque=250):
+    """Lee una hoja con openpyxl en modo read_only y la entrega en bloques de filas,
+    sin cargar el libro completo en memoria.
+    """
+    if hasattr(archivo, "seek"):
+        archivo.seek(0)
+    wb = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        filas = wb[nombre_hoja].iter_rows(values_only=True)
+        encabezado = next(filas, None)
+        if encabezado is None:
+            return
+        columnas = [f"Unnamed: {i}" if c is None else str(c) for i, c in enumerate(encabezado)]
+        n = len(columnas)
+        bloque = []
+        for fila in filas:
+            if all(v is None for v in fila):
+                continue
+            bloque.append(tuple(fila[:n]) + (None,) * (n - len(fila)))
+            if len(bloque) == filas_por_bloque:
+                yield pd.DataFrame.from_records(bloque, columns=columnas)
+                bloque = []
+        if bloque:
+            yield pd.DataFrame.from_records(bloque, columns=columnas)
+    finally:
+        wb.close()
+
+
+def escribir_parte(directorio, tabla, n, df):
+    """Guarda un lote de `tabla` como parquet en `directorio/tabla/parte_NNNNN.parquet`."""
+    carpeta = os.path.join(directorio, tabla)
+    os.makedirs(carpeta, exist_ok=True)
+    for col in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in TIPOS_PARQUET:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.to_parquet(os.path.join(carpeta, f"parte_{n:05d}.parquet"), index=False)
+
+
+def iterar_partes(directorio, tabla, columnas=None):
+    """Lee las partes de `tabla` una por una, en orden (solo `columnas` si se indican)."""
+    carpeta = os.path.join(directorio, tabla)
+    if not os.path.isdir(carpeta):
+        return
+    for nombre in sorted(os.listdir(carpeta)):
+        yield pd.read_parquet(os.path.join(carpeta, nombre), columns=columnas)
+
+
+class TablaParquet:
+    """Una tabla guardada en partes parquet (`directorio/tabla`) vista como una sola.
+    `tabla` puede ser una lista de tablas, que se leen una tras otra.
+
+    Para paginar solo se leen las partes y columnas de las filas pedidas; el número de
+    filas y las columnas salen de los metadatos, sin leer los datos.
+    """
+
+    def __init__(self, directorio, tabla):
+        self.archivos = []
+        for nombre_tabla in [tabla] if isinstance(tabla, str) else tabla:
+            carpeta = os.path.join(directorio, nombre_tabla)
+            nombres = sorted(os.listdir(carpeta)) if os.path.isdir(carpeta) else []
+            self.archivos += [os.path.join(carpeta, n) for n in nombres]
+        self._columnas_parte, filas, columnas = [], [], []
+        for archivo in self.archivos:
+            metadatos = pq.ParquetFile(archivo)
+            self._columnas_parte.append(metadatos.schema_arrow.names)
+            filas.append(metadatos.metadata.num_rows)
+            columnas += [c for c in metadatos.schema_arrow.names if c not in columnas]
+        self.columns = pd.Index(columnas)
+        self._inicios = np.cumsum([0] + filas)
+
+    def __len__(self):
+        return int(self._inicios[-1])
+
+    @property
+    def empty(self):
+        return len(self) == 0 or len(self.columns) == 0
+
+    def _leer(self, i, columnas=None):
+        if columnas is None:
+            return pd.read_parquet(self.archivos[i])
+        presentes = [c for c in columnas if c in self._columnas_parte[i]]
+        return pd.read_parquet(self.archivos[i], columns=presentes).reindex(columns=columnas)
+
+    def partes(self, columnas=None):
+        """Las partes en orden, una por una."""
+        for i in range(len(self.archivos)):
+            yield self._leer(i, columnas)
+
+    def columna(self, nombre):
+        """Una columna completa (p. ej. para ordenar), leyendo solo esa columna de cada parte."""
+        partes = [p[nombre] for p in self.partes([nombre])]
+        return pd.concat(partes, ignore_index=True) if partes else pd.Series(dtype=object, name=nombre)
+
+    def tomar(self, posiciones, columnas=None):
+        """Filas en las posiciones globales indicadas, en ese orden."""
+        columnas = list(self.columns) if columnas is None else list(columnas)
+        posiciones = np.asarray(posiciones, dtype=int)
+        parte_de = np.searchsorted(self._inicios, posiciones, side="right") - 1
+        trozos, orden = [], []
+        for i in np.unique(parte_de):
+            donde = np.flatnonzero(parte_de == i)
+            trozos.append(self._leer(i, columnas).iloc[posiciones[donde] - self._inicios[i]])
+            orden.append(donde)
+        if not trozos:
+            return pd.DataFrame(columns=columnas)
+        df = pd.concat(trozos, ignore_index=True)
+        return df.iloc[np.argsort(np.concatenate(orden), kind="stable")].reset_index(drop=True)
+
+
+def medir_pico(funcion):
+    """Ejecuta `funcion()` y devuelve (resultado, pico de memoria Python en bytes) medido con
+    tracemalloc (numpy y pandas también reportan sus buffers). Si tracemalloc ya estaba
+    activo (otra medición en curso) no se reinicia su pico: la cifra es una cota superior.
+    """
+    ya_activo = tracemalloc.is_tracing()
+    if not ya_activo:
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        resultado = funcion()
+        pico = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if not ya_activo:
+            tracemalloc.stop()
+    return resultado, pico
+
+
+def procesar_fuera_de_memoria(archivo, nombre_hoja, df_postgres_lookup, df_dni, df_labores, directorio,
+                              presupuesto_mb=512, procesar=procesar_distribucion):
+    """Pasa el tareo por el pipeline en lotes de filas dimensionados según `presupuesto_mb`.
+    Cada lote se normaliza, se procesa y se escribe en parquet (tablas tareo, merged y
+    final dentro de `directorio`), y se libera antes de leer el siguiente.
+
+    El tamaño del lote sale de medir: el primer bloque de la hoja se procesa como un lote
+    propio con tracemalloc y el presupuesto se divide por su pico por fila.
+
+    Las decisiones globales (`decidir_distribucion`) no se conocen hasta leer todo el
+    tareo: se procesa suponiendo las de un tareo con fechas y con DNI en el maestro, y si
+    las del tareo completo resultan otras se hace una segunda pasada con ellas.
+    Devuelve un resumen con filas, lotes, filas por lote, bytes por fila y pasadas.
+    """
+    decisiones = {"fecha_de": "FECHA", "nombres_desde_apellidos": True}
+    filas_por_lote = bytes_por_fila = None
+    for pasada in (1, 2):
+        for tabla in ["tareo", "merged", "final"]:
+            shutil.rmtree(os.path.join(directorio, tabla), ignore_errors=True)
+        resumen = _pasada_fuera_de_memoria(
+            archivo, nombre_hoja, df_postgres_lookup, df_dni, df_labores, directorio,
+            presupuesto_mb * 2**20, procesar, decisiones, filas_por_lote
+        )
+        filas_por_lote = resumen["filas_por_lote"]
+        bytes_por_fila = bytes_por_fila or resumen["bytes_por_fila"]
+        if resumen["decisiones"] == decisiones:
+            break
+        decisiones = resumen["decisiones"]
+    return {
+        "filas": resumen["filas"], "lotes": resumen["lotes"], "filas_por_lote": filas_por_lote,
+        "bytes_por_fila": bytes_por_fila, "pasadas": pasada,
+    }
+
+
+def _pasada_fuera_de_memoria(archivo, nombre_hoja, df_postgres_lookup, df_dni, df_labores, directorio,
+                             presupuesto, procesar, decisiones, filas_por_lote=None):
+    n_lote = fila_inicial = 0
+    observadas = None
+    bytes_por_fila = None
+
+    def procesar_lote(bloques):
+        nonlocal n_lote, fila_inicial, observadas
+        lote = normalizar_tareo(pd.concat(bloques, ignore_index=True) if bloques else pd.DataFrame())
+        lote["_fila_tareo"] = range(fila_inicial, fila_inicial + len(lote))
+        fila_inicial += len(lote)
+        observadas = combinar_decisiones(observadas, decidir_distribucion(lote, df_dni))
+        df_merged, df_final = procesar(lote, df_postgres_lookup, df_dni, df_labores, decisiones=decisiones)
+        escribir_parte(directorio, "tareo", n_lote, lote)
+        del lote
+        escribir_parte(directorio, "merged", n_lote, df_merged)
+        del df_merged
+        escribir_parte(directorio, "final", n_lote, df_final)
+        del df_final
+        gc.collect()
+        n_lote += 1
+
+    pendientes, filas_pendientes = [], 0
+    for bloque in leer_hoja_por_bloques(archivo, nombre_hoja):
+        if filas_por_lote is None:
+            # Lote de calibración: cuánta memoria usa el pipeline por fila del tareo
+            _, pico = medir_pico(lambda: procesar_lote([bloque]))
+            bytes_por_fila = pico / max(len(bloque), 1)
+            filas_por_lote = int(min(max(presupuesto // max(bytes_por_fila, 1), 100), 500_000))
+            continue
+        pendientes.append(bloque)
+        filas_pendientes += len(bloque)
+        while filas_pendientes >= filas_por_lote:
+            # El sobrante del último bloque pasa al lote siguiente
+            acumulado = pd.concat(pendientes, ignore_index=True)
+            procesar_lote([acumulado.iloc[:filas_por_lote]])
+            resto = acumulado.iloc[filas_por_lote:].reset_index(drop=True)
+            pendientes, filas_pendientes = ([resto] if len(resto) else []), len(resto)
+            del acumulado
+    if pendientes or n_lote == 0:
+        procesar_lote(pendientes)
+
+    return {
+        "filas": fila_inicial, "lotes": n_lote, "filas_por_lote": filas_por_lote,
+        "bytes_por_fila": bytes_por_fila, "decisiones": observadas,
+    }
+
+
+# ---------------- Escritura de resultados en PostgreSQL ----------------
+TABLA_RESULTADOS = "raw.pe_ccoz_distribuciongth_resultado"
+
+# Columna del resultado final -> columna en la tabla de resultados
+COLUMNAS_RESULTADOS = {
+    "AREA": "area", "GRUPO": "grupo", "COD": "cod", "SEM": "sem", "FECHA": "fecha",
+    "CODIGO": "codigo", "DESCRIPCION DE LABOR": "descripcion_labor", "CECO_FINAL": "ceco_final",
+    "F. INGRESO": "fecha_ingreso", "N° DNI": "dni", "APELLIDOS Y NOMBRES": "apellidos_nombres",
+    "Horas_Dia": "horas_dia", "Horas_Noche": "horas_noche", "ID-ACT-FINAL": "id_act_final",
+    "C_LAB": "c_lab", "TXT DÍA": "txt_dia", "TXT NOCHE": "txt_noche",
+}
+COLUMNAS_RESULTADOS_FECHA = ["fecha", "fecha_ingreso"]
+COLUMNAS_RESULTADOS_NUMERO = ["horas_dia", "horas_noche"]
+
+DDL_RESULTADOS = f"""
+CREATE TABLE IF NOT EXISTS {TABLA_RESULTADOS} (
+    id_carga text NOT NULL,
+    linea integer NOT NULL,
+    area text, grupo text, cod text, sem text, fecha date, codigo text,
+    descripcion_labor text, ceco_final text, fecha_ingreso date, dni text,
+    apellidos_nombres text, horas_dia numeric(12, 2), horas_noche numeric(12, 2),
+    id_act_final text, c_lab text, txt_dia text, txt_noche text,
+    fecha_carga timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (id_carga, linea)
+);
+"""
+
+
+def crear_tabla_resultados(conn):
+    """Crea TABLA_RESULTADOS si no existe. Es un paso de instalación: lo corre un rol
+    con CREATE sobre el esquema (p. ej. `prueba_carga.py --preparar-bd`), no la app.
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(DDL_RESULTADOS)
+
+
+def escribir_resultados_postgres(df_result, id_carga, conn, tam_lote=50000):
+    """Escribe el resultado final en TABLA_RESULTADOS con COPY FROM STDIN, por lotes
+    y dentro de una sola transacción. Es idempotente por `id_carga`: las filas previas
+    de esa carga se reemplazan. La tabla debe existir (ver `crear_tabla_resultados`).
+    Los nulos viajan como \\N, así un texto vacío se guarda como '' y no como NULL.
+    `df_result` puede ser un DataFrame o una `TablaParquet` (se escribe parte por parte).
+    Devuelve el número de filas escritas.
+    """
+    partes = df_result.partes() if isinstance(df_result, TablaParquet) else [df_result]
+    copy_sql = (
+        f"COPY {TABLA_RESULTADOS} (id_carga, linea, {', '.join(COLUMNAS_RESULTADOS.values())}) "
+        r"FROM STDIN WITH (FORMAT csv, NULL '\N')"
+    )
+
+    escritas = 0
+    with conn:  # commit al terminar, rollback si algo falla
+        with conn.cursor() as cur:
+            # Serializa escrituras concurrentes de la misma carga
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (id_carga,))
+            cur.execute(f"DELETE FROM {TABLA_RESULTADOS} WHERE id_carga = %s", (id_carga,))
+            for parte in partes:
+                datos = parte.reindex(columns=list(COLUMNAS_RESULTADOS)).rename(columns=COLUMNAS_RESULTADOS)
+                for col in COLUMNAS_RESULTADOS_FECHA:
+                    datos[col] = pd.to_datetime(datos[col], errors="coerce").dt.strftime("%Y-%m-%d")
+                for col in COLUMNAS_RESULTADOS_NUMERO:
+                    datos[col] = pd.to_numeric(datos[col], errors="coerce")
+                datos.insert(0, "id_carga", id_carga)
+                datos.insert(1, "linea", range(escritas + 1, escritas + len(datos) + 1))
+                escritas += len(datos)
+                for inicio in range(0, len(datos), tam_lote):
+                    buffer = StringIO()
+                    datos.iloc[inicio:inicio + tam_lote].to_csv(buffer, index=False, header=False, na_rep=r"\N")
+                    buffer.seek(0)
+                    cur.copy_expert(copy_sql, buffer)
+    return escritas
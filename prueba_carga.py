@@ -0,0 +1,415 @@
+"""Prueba de carga con sesiones concurrentes para Distribucion10_1.py y almacen_final.py.
+
+Cada sesión corre la app sin navegador con la API de pruebas de Streamlit (AppTest),
+sube un Excel sintético, aplica un filtro y vuelve a ejecutar el script. Cada sesión
+corre en su propio intérprete (spawn) y todas arrancan a la vez: compiten por CPU y por
+el mismo Postgres local, y de cada una salen sus latencias por paso y su memoria.
+
+AppTest no admite varias sesiones en un mismo proceso (cada `run()` reemplaza y luego
+borra el Runtime y st.secrets del proceso), así que no se mide lo que las sesiones de un
+servidor real comparten: cada proceso llena su propia caché de maestros y su pool.
+Una ejecución cuyo hilo del script muere sin mostrar una excepción en la app también
+cuenta como error de la sesión.
+
+El paso "descarga" es una ejecución más del script (`run()`): AppTest no puede pulsar
+un download_button, así que mide la reejecución que provoca el botón, que con los
+resultados ya en la sesión no vuelve a calcular ni a armar el xlsx.
+
+Uso:
+    python prueba_carga.py --app ambas --sesiones 8 --filas 5000 \\
+        --pg-host localhost --pg-dbname postgres --pg-user postgres --preparar-bd
+
+`--preparar-bd` crea raw.pe_ccoz_distribuciongth en el Postgres local y la llena con
+porcentajes sintéticos solo si la tabla está vacía; también crea la tabla de resultados
+(raw.pe_ccoz_distribuciongth_resultado), que la app ya no crea al guardar.
+`--probar-escritura` no corre sesiones: escribe dos veces un resultado sintético con la
+misma clave de carga y comprueba que no se dupliquen filas ni se pierdan textos vacíos.
+No usar contra la base productiva.
+"""
+import argparse
+import datetime as dt
+import io
+import json
+import multiprocessing as mp
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+APPS = {
+    "distribucion": os.path.join(DIRECTORIO, "Distribucion10_1.py"),
+    "almacen": os.path.join(DIRECTORIO, "almacen_final.py"),
+}
+FECHA_INICIO = dt.date(2025, 1, 1)
+DIAS = 28
+
+
+# ---------------- Datos sintéticos ----------------
+def generar_tareo(filas, semilla=0):
+    """Libro con hojas TAREO PACKING, DNI y LABORES como las que sube el usuario."""
+    rng = np.random.default_rng(semilla)
+    fechas = [FECHA_INICIO + dt.timedelta(days=int(d)) for d in rng.integers(0, DIAS, filas)]
+    n_trabajadores = max(1, filas // 20)
+    dnis = [str(40000000 + int(i)) for i in rng.integers(0, n_trabajadores, filas)]
+    tareo = pd.DataFrame({
+        "AREA": rng.choice(["PRODUCCION", "RECEPCION", "SSOMA", "ALMACEN DE PISO PRODUCCION", "CALIDAD"], filas),
+        "GRUPO": rng.choice(["G1", "G2", "G3"], filas),
+        "COD": rng.integers(1, 9, filas),
+        "SEM": [f.isocalendar()[1] for f in fechas],
+        "FECHA": fechas,
+        "CODIGO": rng.choice([f"L{i}" for i in range(1, 21)], filas),
+        "DESCRIPCION DE LABOR": "",
+        "CECO": rng.choice(["RECEP_PACK", "C100", "C200"], filas),
+        "N° DNI": dnis,
+        "APELLIDOS Y NOMBRES": [f"TRABAJADOR {d}" for d in dnis],
+        "HE_D": rng.choice([8.0, 4.5, 0.0], filas),
+        "H_NOCTURNAS": rng.choice([0.0, 2.0, 3.25], filas),
+    })
+    dni = pd.DataFrame({
+        "DNI": [str(40000000 + i) for i in range(n_trabajadores)],
+        "FECHA_INGRESO": FECHA_INICIO - dt.timedelta(days=365),
+        "APELLIDOS": [f"APELLIDO {i}" for i in range(n_trabajadores)],
+    })
+    labores = pd.DataFrame({
+        "CODIGO": [f"L{i}" for i in range(1, 21)],
+        "LABOR": [f"LABOR {i}" for i in range(1, 21)],
+        "ID_ACT": [100 + i for i in range(1, 21)],
+        "COD_LAB": [f"{i:04d}" for i in range(1, 21)],
+    })
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        tareo.to_excel(writer, index=False, sheet_name="TAREO PACKING")
+        dni.to_excel(writer, index=False, sheet_name="DNI")
+        labores.to_excel(writer, index=False, sheet_name="LABORES")
+    return buffer.getvalue()
+
+
+def generar_almacen(filas, semilla=0):
+    """Libro con las columnas requeridas por almacen_final.py."""
+    rng = np.random.default_rng(semilla)
+    df = pd.DataFrame({
+        "Item": np.arange(1, filas + 1),
+        "Descripción": [f"ITEM {i}" for i in range(filas)],
+        "Unidad": "UND",
+        "Cantidad": rng.integers(1, 100, filas),
+        "Precio": rng.uniform(1, 50, filas).round(2),
+        "%DR": 0,
+        "Subtotal": rng.uniform(1, 5000, filas).round(2),
+        "Lote": [f"LT{i % 50}" for i in range(filas)],
+        "Fecha Vcto": FECHA_INICIO + dt.timedelta(days=365),
+        "Centro Costo": rng.choice(["C100", "C200"], filas),
+        "Desc. Centro Costo": "CENTRO",
+        "Bodega": "B01",
+        "Descripción Bodega": "BODEGA",
+        "Observación": "",
+        "TC": rng.choice([3.7512, 3.7518, 3.802, 3.8111], filas),
+    })
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False, engine="xlsxwriter")
+    return buffer.getvalue()
+
+
+def preparar_bd(secretos):
+    """Crea la tabla de resultados y crea y llena raw.pe_ccoz_distribuciongth en el
+    Postgres local si está vacía. Devuelve True si llenó los porcentajes."""
+    import psycopg2
+    from distribucion_pipeline import crear_tabla_resultados
+
+    conn = psycopg2.connect(**secretos)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("CREATE SCHEMA IF NOT EXISTS raw")
+        crear_tabla_resultados(conn)
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS raw.pe_ccoz_distribuciongth "
+                "(fecha date, area text, packing numeric, servicio_maquila numeric)"
+            )
+            cur.execute("SELECT count(*) FROM raw.pe_ccoz_distribuciongth")
+            if cur.fetchone()[0] > 0:
+                return False
+            rng = np.random.default_rng(0)
+            buffer = io.StringIO()
+            for d in range(DIAS):
+                for area in ["PRODUCCION", "RECEPCION"]:
+                    packing = round(float(rng.uniform(0.3, 0.8)), 4)
+                    buffer.write(f"{FECHA_INICIO + dt.timedelta(days=d)},{area},{packing},{round(1 - packing, 4)}\n")
+            buffer.seek(0)
+            cur.copy_expert(
+                "COPY raw.pe_ccoz_distribuciongth (fecha, area, packing, servicio_maquila) FROM STDIN WITH (FORMAT csv)",
+                buffer,
+            )
+        return True
+    finally:
+        conn.close()
+
+
+# ---------------- Escritura de resultados ----------------
+def generar_resultado(filas, semilla=0):
+    """Resultado final sintético con las columnas que guarda la app, incluidos textos
+    vacíos y nulos para comprobar que COPY los distingue."""
+    rng = np.random.default_rng(semilla)
+    fechas = [FECHA_INICIO + dt.timedelta(days=int(d)) for d in rng.integers(0, DIAS, filas)]
+    df = pd.DataFrame({
+        "AREA": rng.choice(["PRODUCCION", "RECEPCION"], filas),
+        "GRUPO": rng.choice(["G1", "G2", ""], filas),
+        "COD": "E001", "SEM": "1", "FECHA": fechas,
+        "CODIGO": rng.choice(["0012", "0345"], filas),
+        "DESCRIPCION DE LABOR": rng.choice(["COSECHA", ""], filas),
+        "CECO_FINAL": rng.choice(["PACKING", "MAQUILA"], filas),
+        "F. INGRESO": "2024-01-15",
+        "N° DNI": [f"{40000000 + i}" for i in rng.integers(0, 500, filas)],
+        "APELLIDOS Y NOMBRES": "",
+        "Horas_Dia": rng.uniform(0, 8, filas).round(2),
+        "Horas_Noche": rng.uniform(0, 4, filas).round(2),
+        "ID-ACT-FINAL": "", "C_LAB": "", "TXT DÍA": "", "TXT NOCHE": "",
+    })
+    df.loc[::7, "APELLIDOS Y NOMBRES"] = None
+    df.loc[::5, "F. INGRESO"] = None
+    return df
+
+
+def probar_escritura(secretos, filas):
+    """Escribe dos veces el mismo resultado con la misma id_carga y comprueba que el
+    conteo no cambie y que '' y NULL lleguen tal cual. Borra la carga de prueba al final.
+    Devuelve una lista de errores (vacía si todo salió bien)."""
+    import psycopg2
+    from distribucion_pipeline import TABLA_RESULTADOS, escribir_resultados_postgres
+
+    df = generar_resultado(filas)
+    id_carga = "prueba_carga"
+    errores = []
+    conn = psycopg2.connect(**secretos)
+    try:
+        conteos = []
+        for _ in range(2):
+            escritas = escribir_resultados_postgres(df, id_carga, conn, tam_lote=max(filas // 3, 1))
+            with conn, conn.cursor() as cur:
+                cur.execute(
+                    f"SELECT count(*), count(*) FILTER (WHERE apellidos_nombres = ''), "
+                    f"count(*) FILTER (WHERE apellidos_nombres IS NULL), "
+                    f"count(*) FILTER (WHERE fecha_ingreso IS NULL) "
+                    f"FROM {TABLA_RESULTADOS} WHERE id_carga = %s",
+                    (id_carga,),
+                )
+                conteos.append(cur.fetchone())
+            if escritas != len(df):
+                errores.append(f"se escribieron {escritas} filas de {len(df)}")
+        esperado = (
+            len(df),
+            int((df["APELLIDOS Y NOMBRES"] == "").sum()),
+            int(df["APELLIDOS Y NOMBRES"].isna().sum()),
+            int(df["F. INGRESO"].isna().sum()),
+        )
+        for i, conteo in enumerate(conteos, start=1):
+            if tuple(conteo) != esperado:
+                errores.append(f"escritura {i}: (filas, vacíos, nulos, fechas nulas) = {tuple(conteo)}, se esperaba {esperado}")
+        with conn, conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {TABLA_RESULTADOS} WHERE id_carga = %s", (id_carga,))
+    finally:
+        conn.close()
+    return errores
+
+
+# ---------------- Sesión ----------------
+class ArchivoSubido(io.BytesIO):
+    """Imita el UploadedFile de Streamlit (BytesIO con nombre)."""
+
+    def __init__(self, datos, nombre):
+        super().__init__(datos)
+        self.name = nombre
+
+
+# Excepciones de hilos que mueren sin pasar por la app (p. ej. el hilo del script)
+_ERRORES_DE_HILOS = []
+
+
+def _registrar_error_de_hilo(args):
+    _ERRORES_DE_HILOS.append(f"{args.exc_type.__name__}: {args.exc_value}")
+    threading.__excepthook__(args)
+
+
+def preparar_app(app, datos):
+    """Reemplaza st.file_uploader para que devuelva el Excel sintético y registra las
+    excepciones de hilos. Son cambios del proceso, así que se hacen una vez por proceso."""
+    import streamlit as st
+
+    nombre = "carga_tareo.xlsx" if app == "distribucion" else "carga_almacen.xlsx"
+    st.file_uploader = lambda *args, **kwargs: ArchivoSubido(datos, nombre)
+    threading.excepthook = _registrar_error_de_hilo
+
+
+def _paso(at, mediciones, nombre, timeout):
+    errores_previos = len(_ERRORES_DE_HILOS)
+    inicio = time.perf_counter()
+    at.run(timeout=timeout)
+    mediciones.append({"paso": nombre, "segundos": time.perf_counter() - inicio})
+    if at.exception:
+        raise RuntimeError(f"{nombre}: {at.exception[0].message}")
+    if len(_ERRORES_DE_HILOS) > errores_previos:
+        raise RuntimeError(f"{nombre}: el script no terminó ({_ERRORES_DE_HILOS[errores_previos]})")
+
+
+def ejecutar_sesion(app_test, app, secretos, barrera, timeout):
+    """Corre una sesión completa con `app_test` (la clase AppTest) y devuelve las
+    latencias por paso. Requiere `preparar_app` en el proceso."""
+    at = app_test.from_file(APPS[app], default_timeout=timeout)
+    at.secrets["postgres"] = dict(secretos)
+    mediciones, error = [], None
+
+    barrera.wait()  # todas las sesiones arrancan a la vez
+    inicio = time.perf_counter()
+    try:
+        _paso(at, mediciones, "carga", timeout)
+        if app == "distribucion":
+            area = at.sidebar.multiselect[0]
+            area.select(area.options[0])
+            _paso(at, mediciones, "filtro", timeout)
+        else:
+            at.slider[0].set_value(1)
+            _paso(at, mediciones, "filtro", timeout)
+            tc = at.selectbox[0]
+            tc.select(tc.options[-1])
+            _paso(at, mediciones, "seleccion_tc", timeout)
+        if not at.get("download_button"):
+            raise RuntimeError("descarga: no se generó el botón de descarga")
+        # AppTest no puede pulsar el download_button: se mide la reejecución que provoca
+        _paso(at, mediciones, "descarga", timeout)
+    except Exception as e:
+        error = str(e)
+
+    return {
+        "app": app,
+        "pid": os.getpid(),
+        "segundos_sesion": time.perf_counter() - inicio,
+        "pasos": mediciones,
+        "error": error,
+    }
+
+
+def _sesion_en_proceso(args):
+    """Una sesión en un intérprete propio. La memoria se mide sobre la base tras importar
+    Streamlit, que no cuenta como memoria de la sesión."""
+    from streamlit.testing.v1 import AppTest
+
+    app, datos, secretos, barrera, timeout, memoria_python = args
+    preparar_app(app, datos)
+    rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if memoria_python:
+        tracemalloc.start()
+    resultado = ejecutar_sesion(AppTest, app, secretos, barrera, timeout)
+    resultado["rss_mb"] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_base) / 1024
+    resultado["pico_python_mb"] = None
+    if memoria_python:
+        resultado["pico_python_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return resultado
+
+
+def correr_en_procesos(app, datos, secretos, sesiones, timeout, memoria_python=False):
+    """N sesiones, cada una en su proceso (spawn). Devuelve los resultados por sesión y
+    la memoria por sesión (pico de RSS de cada proceso sobre su base tras importar)."""
+    ctx = mp.get_context("spawn")
+    with ctx.Manager() as manager, ProcessPoolExecutor(max_workers=sesiones, mp_context=ctx) as pool:
+        barrera = manager.Barrier(sesiones)
+        tareas = [(app, datos, secretos, barrera, timeout, memoria_python) for _ in range(sesiones)]
+        resultados = list(pool.map(_sesion_en_proceso, tareas))
+    memoria = {
+        "app": app, "sesiones": sesiones,
+        "rss_mb_p50": float(np.median([r["rss_mb"] for r in resultados])),
+        "rss_mb_max": max(r["rss_mb"] for r in resultados),
+    }
+    if memoria_python:
+        memoria["python_mb_p50"] = float(np.median([r["pico_python_mb"] for r in resultados]))
+        memoria["python_mb_max"] = max(r["pico_python_mb"] for r in resultados)
+    return resultados, memoria
+
+
+# ---------------- Reporte ----------------
+def percentiles(valores, ps=(50, 90, 95, 99)):
+    valores = np.asarray(valores, dtype=float)
+    return {f"p{p}": float(np.percentile(valores, p)) for p in ps} | {"max": float(valores.max())}
+
+
+def resumir(resultados, memorias):
+    filas_latencia = []
+    for app in sorted({r["app"] for r in resultados}):
+        de_app = [r for r in resultados if r["app"] == app]
+        pasos = pd.DataFrame([p | {"app": app} for r in de_app for p in r["pasos"]])
+        for paso, grupo in pasos.groupby("paso", sort=False):
+            filas_latencia.append({"app": app, "paso": paso, "n": len(grupo)} | percentiles(grupo["segundos"]))
+        filas_latencia.append(
+            {"app": app, "paso": "sesion", "n": len(de_app)} | percentiles([r["segundos_sesion"] for r in de_app])
+        )
+    memoria = pd.DataFrame(memorias)
+    memoria.insert(2, "errores", [sum(r["error"] is not None for r in resultados if r["app"] == m["app"]) for m in memorias])
+    return pd.DataFrame(filas_latencia), memoria
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--app", choices=["distribucion", "almacen", "ambas"], default="ambas")
+    parser.add_argument("--sesiones", type=int, default=4, help="sesiones concurrentes por app")
+    parser.add_argument("--filas", type=int, default=2000, help="filas del Excel sintético")
+    parser.add_argument("--timeout", type=float, default=600, help="segundos máximos por ejecución del script")
+    parser.add_argument("--pg-host", default=os.environ.get("PGHOST", "localhost"))
+    parser.add_argument("--pg-port", default=os.environ.get("PGPORT", "5432"))
+    parser.add_argument("--pg-dbname", default=os.environ.get("PGDATABASE", "postgres"))
+    parser.add_argument("--pg-user", default=os.environ.get("PGUSER", "postgres"))
+    parser.add_argument("--pg-password", default=os.environ.get("PGPASSWORD", ""))
+    parser.add_argument("--pg-sslmode", default="disable")
+    parser.add_argument("--memoria-python", action="store_true", help="medir también el pico con tracemalloc (más lento)")
+    parser.add_argument("--preparar-bd", action="store_true", help="crear y llenar la tabla de porcentajes si está vacía")
+    parser.add_argument("--probar-escritura", action="store_true",
+                        help="solo comprobar que guardar el resultado dos veces no duplica filas")
+    parser.add_argument("--json", help="guardar también los resultados crudos en este archivo")
+    args = parser.parse_args()
+
+    secretos = {
+        "host": args.pg_host, "port": args.pg_port, "dbname": args.pg_dbname,
+        "user": args.pg_user, "password": args.pg_password, "sslmode": args.pg_sslmode,
+    }
+    apps = ["distribucion", "almacen"] if args.app == "ambas" else [args.app]
+    if ("distribucion" in apps or args.probar_escritura) and args.preparar_bd:
+        print("Tabla de porcentajes creada." if preparar_bd(secretos) else "Tabla de porcentajes ya tenía datos.")
+    if args.probar_escritura:
+        errores = probar_escritura(secretos, args.filas)
+        for error in errores:
+            print(f"[escritura] ERROR {error}")
+        print(f"Escritura de resultados: {'ERROR' if errores else 'OK'} ({args.filas:,} filas, dos veces la misma carga)")
+        raise SystemExit(1 if errores else 0)
+
+    resultados, memorias = [], []
+    for app in apps:
+        datos = generar_tareo(args.filas) if app == "distribucion" else generar_almacen(args.filas)
+        print(f"{app}: {args.sesiones} sesiones concurrentes, {args.filas:,} filas ({len(datos) / 2**20:.1f} MB)")
+        resultados_app, memoria = correr_en_procesos(
+            app, datos, secretos, args.sesiones, args.timeout, args.memoria_python
+        )
+        resultados.extend(resultados_app)
+        memorias.append(memoria)
+
+    for r in resultados:
+        if r["error"]:
+            print(f"[{r['app']} pid {r['pid']}] ERROR {r['error']}")
+
+    latencias, memoria = resumir(resultados, memorias)
+    print("\nLatencia por paso (segundos)")
+    print(latencias.to_string(index=False, float_format="{:.3f}".format))
+    print('"descarga" es una ejecución más del script (AppTest no pulsa el download_button).')
+    print("\nMemoria por sesión (MB; RSS = pico de cada proceso sobre la base tras importar)")
+    print(memoria.to_string(index=False, float_format="{:.1f}".format))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"sesiones": resultados, "memoria": memorias}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
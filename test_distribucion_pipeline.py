@@ -0,0 +1,336 @@
+import datetime as dt
+import os
+
+import pandas as pd
+import pytest
+
+from distribucion_pipeline import (
+    CLAVE_RESUMEN, COLUMNAS_EXCEPCIONES, TABLA_RESULTADOS, MaestrosCompartidos, PoolCompartido, TablaParquet,
+    concatenar_partes, crear_tabla_resultados, escribir_parte, escribir_resultados_postgres, iterar_partes,
+    normalizar_tareo, procesar_delta, procesar_distribucion, procesar_fuera_de_memoria, procesar_por_shards,
+    resumen_validacion, validar_distribucion
+)
+
+D1, D2 = dt.date(2025, 1, 1), dt.date(2025, 1, 2)
+
+
+def tareo_de_prueba():
+    """3 filas en 2 fechas más una sin FECHA; solo el DNI de la primera fecha está en el maestro."""
+    return normalizar_tareo(pd.DataFrame({
+        "N° DNI": ["1", "2", "3", "4"],
+        "FECHA": [D1, D2, D2, None],
+        "FECHA REGISTRO": [D1, D2, D2, D1],
+        "SEM": [1, 1, 2, 1],
+        "AREA": ["PRODUCCION", "SSOMA", "RECEPCION", "PRODUCCION"],
+        "CECO": ["C1", "C2", "RECEP_PACK", "C1"],
+        "CODIGO": ["10", "20", "10", "20"],
+        "HE_D": [8.0, 6.0, 4.0, 2.0],
+        "H_NOCTURNAS": [0.0, 2.0, 1.0, 0.0],
+        "APELLIDOS Y NOMBRES": ["A", "B", "C", "D"],
+    }))
+
+
+def maestros_de_prueba():
+    df_dni = pd.DataFrame({"DNI": ["1"], "FECHA_INGRESO": [dt.date(2020, 1, 1)], "APELLIDOS": ["PEREZ A"]})
+    df_labores = pd.DataFrame({
+        "CODIGO": ["10", "20"], "Labor": ["COSECHA", "EMPAQUE"], "ID_ACTIVIDAD": [12, 34], "COD_LABOR": [5, 6],
+    })
+    _, df_dni, df_labores = MaestrosCompartidos().aplicar(df_dni, df_labores)
+    return df_dni, df_labores
+
+
+def lookup_de_prueba():
+    return pd.DataFrame({
+        "fecha": [D1, D1, D2, D2], "area": ["PRODUCCION", "RECEPCION"] * 2,
+        "packing": [0.6, 0.5, 0.7, 0.4], "SERVICIO MAQUILA": [0.4, 0.5, 0.3, 0.6],
+    })
+
+
+
+def hoja_dni(apellidos):
+    return pd.DataFrame({
+        "DNI": [" 1", "2"], "FECHA_INGRESO": [dt.date(2020, 1, 1), dt.date(2021, 1, 1)], "APELLIDOS": apellidos,
+    })
+
+
+def test_maestros_reaplicar_la_misma_hoja_no_cambia_la_version():
+    maestros = MaestrosCompartidos()
+    v1, dni_1, _ = maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ B"]), pd.DataFrame())
+    v2, dni_2, _ = maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ B"]), pd.DataFrame())
+    assert v1 == v2 == 1
+    assert dni_2 is dni_1
+
+
+def test_maestros_delta_reemplaza_solo_las_claves_cambiadas():
+    maestros = MaestrosCompartidos()
+    _, dni_1, _ = maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ B"]), pd.DataFrame())
+    version, dni_2, _ = maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ C"]), pd.DataFrame())
+
+    assert version == 2
+    assert dni_2["APELLIDOS"].to_dict() == {"1": "PEREZ A", "2": "LOPEZ C"}
+    assert dni_2.loc["1"].equals(dni_1.loc["1"])
+    # la foto anterior no se modifica en sitio
+    assert dni_1.loc["2", "APELLIDOS"] == "LOPEZ B"
+
+
+def test_maestros_delta_agrega_claves_nuevas():
+    maestros = MaestrosCompartidos()
+    maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ B"]), pd.DataFrame())
+    nueva = pd.DataFrame({"DNI": ["3"], "FECHA_INGRESO": [dt.date(2022, 1, 1)], "APELLIDOS": ["DIAZ C"]})
+    version, df_dni, _ = maestros.aplicar(nueva, pd.DataFrame())
+
+    assert version == 2
+    assert df_dni["APELLIDOS"].to_dict() == {"1": "PEREZ A", "2": "LOPEZ B", "3": "DIAZ C"}
+
+
+def test_maestros_hoja_vacia_no_cambia_nada():
+    maestros = MaestrosCompartidos()
+    _, dni_1, labores_1 = maestros.aplicar(hoja_dni(["PEREZ A", "LOPEZ B"]), pd.DataFrame())
+    version, dni_2, labores_2 = maestros.aplicar(pd.DataFrame(), pd.DataFrame(columns=["CODIGO", "Labor"]))
+    assert version == 1
+    assert dni_2 is dni_1 and labores_2 is labores_1
+
+@pytest.mark.parametrize("por", ["FECHA", "SEM"])
+def test_shards_igual_que_secuencial(por):
+    df_tareo = tareo_de_prueba()
+    df_dni, df_labores = maestros_de_prueba()
+    m0, f0 = procesar_distribucion(df_tareo, lookup_de_prueba(), df_dni, df_labores)
+    m1, f1 = procesar_por_shards(df_tareo, lookup_de_prueba(), df_dni, df_labores, por=por, max_workers=2)
+
+    # el DNI 1 está en el maestro: el resto queda sin nombre, igual en todos los shards
+    assert f0.loc[f0["N° DNI"] == "1", "APELLIDOS Y NOMBRES"].eq("PEREZ A").all()
+    assert f0.loc[f0["N° DNI"] != "1", "APELLIDOS Y NOMBRES"].isna().all()
+    pd.testing.assert_frame_equal(f0, f1)
+    pd.testing.assert_frame_equal(m0, m1)
+
+
+def test_pool_compartido_reemplaza_el_pool_si_cambian_los_maestros():
+    df_tareo = tareo_de_prueba()
+    df_dni, df_labores = maestros_de_prueba()
+    _, f0 = procesar_distribucion(df_tareo, lookup_de_prueba(), df_dni, df_labores)
+    pool = PoolCompartido()
+    try:
+        _, f1 = procesar_por_shards(df_tareo, lookup_de_prueba(), df_dni, df_labores, pool=pool, max_workers=2)
+        with pool.usar(df_dni, df_labores, 2) as primero:
+            pass
+        # otros maestros (otro objeto): pool nuevo que los recibe, el anterior se cierra
+        df_dni_2 = df_dni.iloc[:0]
+        _, f2 = procesar_por_shards(df_tareo, lookup_de_prueba(), df_dni_2, df_labores, pool=pool, max_workers=2)
+        with pool.usar(df_dni_2, df_labores, 2) as segundo:
+            pass
+    finally:
+        pool.cerrar()
+
+    pd.testing.assert_frame_equal(f0, f1)
+    assert segundo is not primero
+    with pytest.raises(RuntimeError):
+        primero.submit(int)
+    assert f2["APELLIDOS"].eq("").all()
+
+
+def test_delta_igual_que_corrida_completa():
+    df_dni, df_labores = maestros_de_prueba()
+    lookup = lookup_de_prueba()
+    df_tareo = tareo_de_prueba()
+    _, _, estado, _ = procesar_delta(df_tareo, lookup, df_dni, df_labores, firma=1)
+
+    # solo cambia una fila cuyo DNI no está en el maestro
+    df_tareo.loc[1, "HE_D"] = 7.0
+    m_delta, f_delta, estado, resumen = procesar_delta(df_tareo, lookup, df_dni, df_labores, firma=1, previo=estado)
+    m_completo, f_completo = procesar_distribucion(df_tareo, lookup, df_dni, df_labores)
+    assert resumen["modificadas"] == 1 and resumen["reutilizadas"] == 3
+    pd.testing.assert_frame_equal(f_delta, f_completo)
+    pd.testing.assert_frame_equal(m_delta, m_completo)
+
+    # sin el único DNI del maestro cambia la decisión global: se recalcula todo
+    df_tareo = df_tareo[df_tareo["N° DNI"] != "1"].reset_index(drop=True)
+    _, f_delta, _, resumen = procesar_delta(df_tareo, lookup, df_dni, df_labores, firma=1, previo=estado)
+    _, f_completo = procesar_distribucion(df_tareo, lookup, df_dni, df_labores)
+    assert resumen["reutilizadas"] == 0
+    assert f_delta["APELLIDOS Y NOMBRES"].tolist()[:2] == ["B", "C"]
+    pd.testing.assert_frame_equal(f_delta, f_completo)
+
+
+def sin_marcador_de_nulo(df):
+    # parquet devuelve None donde pandas deja NaN en columnas object
+    return df.apply(lambda s: s.where(s.notna(), None) if s.dtype == object else s)
+
+
+@pytest.mark.parametrize("maestro", ["con_dni", "sin_dni_del_tareo"])
+def test_lotes_igual_que_corrida_completa(tmp_path, maestro):
+    n = 1500
+    pd.DataFrame({
+        "N° DNI": [str(i % 7) for i in range(n)],
+        "FECHA": [(D1, D2)[i % 2] for i in range(n)],
+        "FECHA REGISTRO": D1,
+        "SEM": 1,
+        "AREA": [("PRODUCCION", "SSOMA", "RECEPCION")[i % 3] for i in range(n)],
+        "CECO": [("C1", "C2", "RECEP_PACK")[i % 3] for i in range(n)],
+        "CODIGO": [("10", "20")[i % 2] for i in range(n)],
+        "HE_D": [float(i % 9) for i in range(n)],
+        "H_NOCTURNAS": [float(i % 3) for i in range(n)],
+        "APELLIDOS Y NOMBRES": [f"N{i}" for i in range(n)],
+    }).to_excel(tmp_path / "tareo.xlsx", sheet_name="TAREO", index=False)
+    df_dni, df_labores = maestros_de_prueba()
+    if maestro == "sin_dni_del_tareo":
+        # ningún DNI del tareo en el maestro: la pasada con las decisiones supuestas se repite
+        df_dni = df_dni.rename(index={"1": "999"})
+
+    resumen = procesar_fuera_de_memoria(
+        tmp_path / "tareo.xlsx", "TAREO", lookup_de_prueba(), df_dni, df_labores, tmp_path, presupuesto_mb=0.05
+    )
+    df_tareo = normalizar_tareo(pd.read_excel(tmp_path / "tareo.xlsx", sheet_name="TAREO"))
+    m0, f0 = procesar_distribucion(df_tareo, lookup_de_prueba(), df_dni, df_labores)
+    m1 = concatenar_partes(list(iterar_partes(tmp_path, "merged")))
+    f1 = concatenar_partes(list(iterar_partes(tmp_path, "final")))
+
+    assert resumen["lotes"] > 2
+    assert resumen["pasadas"] == (1 if maestro == "con_dni" else 2)
+    pd.testing.assert_frame_equal(sin_marcador_de_nulo(f0), sin_marcador_de_nulo(f1[f0.columns]))
+    pd.testing.assert_frame_equal(sin_marcador_de_nulo(m0), sin_marcador_de_nulo(m1[m0.columns]))
+
+
+def validar(df_tareo, lookup):
+    df_dni, df_labores = maestros_de_prueba()
+    df_merged, df_final = procesar_distribucion(df_tareo, lookup, df_dni, df_labores)
+    return validar_distribucion(df_tareo, df_merged, df_final)
+
+
+def tareo_con_fechas():
+    """El tareo de prueba sin la fila sin FECHA y con horas de noche en todas las filas."""
+    df_tareo = tareo_de_prueba()
+    df_tareo = df_tareo[df_tareo["FECHA"].notna()].reset_index(drop=True)
+    df_tareo["H_NOCTURNAS"] = 1.0
+    return df_tareo
+
+
+def test_validacion_tareo_limpio_sin_excepciones():
+    excepciones = validar(tareo_con_fechas(), lookup_de_prueba())
+    assert excepciones.empty
+    assert list(excepciones.columns) == COLUMNAS_EXCEPCIONES
+
+
+def test_validacion_porcentajes_que_no_suman_1():
+    lookup = lookup_de_prueba()
+    lookup.loc[0, "SERVICIO MAQUILA"] = 0.3  # PRODUCCION el 1/1: 0.6 + 0.3
+    excepciones = validar(tareo_con_fechas(), lookup)
+
+    pct = excepciones[excepciones["TIPO"] == "PORCENTAJE PACKING+MAQUILA"]
+    assert pct[["FECHA", "AREA"]].values.tolist() == [[D1, "PRODUCCION"]]
+    assert pct[["ESPERADO", "DISTRIBUIDO", "DIFERENCIA"]].values.tolist() == [[1.0, 0.9, -0.1]]
+
+
+def test_validacion_sin_porcentajes_en_postgres():
+    lookup = lookup_de_prueba().iloc[1:]  # falta PRODUCCION el 1/1
+    excepciones = validar(tareo_con_fechas(), lookup)
+
+    horas = excepciones[excepciones["TIPO"].isin(["HORAS DÍA", "HORAS NOCHE"])]
+    assert horas[["TIPO", "N° DNI", "AREA", "ESPERADO", "DISTRIBUIDO"]].values.tolist() == [
+        ["HORAS DÍA", "1", "PRODUCCION", 8.0, 0.0],
+        ["HORAS NOCHE", "1", "PRODUCCION", 1.0, 0.0],
+    ]
+
+
+def test_validacion_tolera_el_redondeo_acumulado():
+    n = 10
+    df_tareo = normalizar_tareo(pd.DataFrame({
+        "N° DNI": "3", "FECHA": [D2] * n, "FECHA REGISTRO": D2, "SEM": 1, "AREA": "RECEPCION",
+        "CECO": "RECEP_PACK", "CODIGO": "10", "HE_D": 0.03, "H_NOCTURNAS": 0.0, "APELLIDOS Y NOMBRES": "C",
+    }))
+    lookup = lookup_de_prueba()
+    lookup.loc[3, ["packing", "SERVICIO MAQUILA"]] = [0.5, 0.5]
+    df_dni, df_labores = maestros_de_prueba()
+    df_merged, df_final = procesar_distribucion(df_tareo, lookup, df_dni, df_labores)
+
+    # cada mitad de 0.03 se redondea a 0.01: 0.1 horas menos en 20 filas distribuidas
+    assert df_final["Horas_Dia"].sum() == pytest.approx(df_tareo["HE_D"].sum() - 0.1)
+    assert validar_distribucion(df_tareo, df_merged, df_final).empty
+
+
+def test_resumen_validacion_separa_por_dni_trabajadores_con_el_mismo_nombre():
+    horas = pd.Series(
+        [8.0, 6.0],
+        index=pd.MultiIndex.from_tuples(
+            [(D1, "PRODUCCION", "1", "PEREZ A", "DIA"), (D1, "PRODUCCION", "2", "PEREZ A", "DIA")],
+            names=CLAVE_RESUMEN + ["TURNO_FINAL"],
+        ),
+    )
+    excepciones = pd.DataFrame(
+        [["HORAS DÍA", D1, "2", "PEREZ A", "PRODUCCION", 8.0, 6.0, -2.0]], columns=COLUMNAS_EXCEPCIONES
+    )
+    resumen = resumen_validacion([horas], excepciones)
+
+    assert resumen[["N° DNI", "Horas", "Validación"]].values.tolist() == [
+        ["1", 8.0, "CORRECTO"],
+        ["2", 6.0, "INCORRECTO"],
+    ]
+
+
+# Postgres local para las pruebas de escritura, p. ej. "host=localhost dbname=postgres user=postgres".
+# Sin la variable esas pruebas se omiten. No usar contra la base productiva.
+PG_DSN = os.environ.get("PG_DSN_PRUEBAS")
+ID_CARGA_PRUEBA = "test_distribucion_pipeline"
+
+
+@pytest.fixture
+def conexion_pg():
+    if not PG_DSN:
+        pytest.skip("PG_DSN_PRUEBAS no está definida")
+    psycopg2 = pytest.importorskip("psycopg2")
+    conn = psycopg2.connect(PG_DSN)
+    with conn, conn.cursor() as cur:
+        cur.execute("CREATE SCHEMA IF NOT EXISTS raw")
+    crear_tabla_resultados(conn)
+    yield conn
+    with conn, conn.cursor() as cur:
+        cur.execute(f"DELETE FROM {TABLA_RESULTADOS} WHERE id_carga = %s", (ID_CARGA_PRUEBA,))
+    conn.close()
+
+
+NOMBRES_PRUEBA = ["", None, "PEREZ A", "", None, "B", "C"]
+INGRESOS_PRUEBA = [None, D2, None, D2, None, D2, None]
+HORAS_NOCHE_PRUEBA = [None, 0.5, None, 0.5, None, 0.5, None]
+
+
+def resultado_de_prueba():
+    return pd.DataFrame({
+        "AREA": "PRODUCCION", "FECHA": D1, "N° DNI": [str(i) for i in range(len(NOMBRES_PRUEBA))],
+        "APELLIDOS Y NOMBRES": NOMBRES_PRUEBA, "F. INGRESO": INGRESOS_PRUEBA,
+        "Horas_Dia": 1.25, "Horas_Noche": HORAS_NOCHE_PRUEBA,
+    })
+
+
+def filas_guardadas(conn):
+    with conn, conn.cursor() as cur:
+        cur.execute(
+            f"SELECT linea, dni, apellidos_nombres, fecha_ingreso, horas_noche FROM {TABLA_RESULTADOS} "
+            "WHERE id_carga = %s ORDER BY linea",
+            (ID_CARGA_PRUEBA,),
+        )
+        return cur.fetchall()
+
+
+def test_escribir_resultados_dos_veces_no_duplica(conexion_pg):
+    df = resultado_de_prueba()
+    for _ in range(2):
+        # tam_lote menor que el resultado: varios COPY en la misma transacción
+        assert escribir_resultados_postgres(df, ID_CARGA_PRUEBA, conexion_pg, tam_lote=3) == len(df)
+    filas = filas_guardadas(conexion_pg)
+
+    assert [f[0] for f in filas] == list(range(1, len(df) + 1))
+    assert [f[1] for f in filas] == df["N° DNI"].tolist()
+    # '' y NULL llegan tal cual, en textos, fechas y números
+    assert [f[2] for f in filas] == NOMBRES_PRUEBA
+    assert [f[3] for f in filas] == INGRESOS_PRUEBA
+    assert [None if f[4] is None else float(f[4]) for f in filas] == HORAS_NOCHE_PRUEBA
+
+
+def test_escribir_resultados_desde_tabla_parquet(conexion_pg, tmp_path):
+    df = resultado_de_prueba()
+    escribir_parte(tmp_path, "resultado", 0, df.iloc[:4].copy())
+    escribir_parte(tmp_path, "resultado", 1, df.iloc[4:].copy())
+    assert escribir_resultados_postgres(TablaParquet(tmp_path, "resultado"), ID_CARGA_PRUEBA, conexion_pg) == len(df)
+    filas = filas_guardadas(conexion_pg)
+
+    assert [f[0] for f in filas] == list(range(1, len(df) + 1))
+    assert [f[2] for f in filas] == NOMBRES_PRUEBA